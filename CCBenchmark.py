@@ -0,0 +1,267 @@
+import json
+import os, sys, time, random, platform, subprocess, tempfile, argparse
+import cc_eventscript_parser as Parser
+from cc_eventscript_parser import TokenType
+
+# ~ benchmarks for the cc-eventscript parser ~
+# generates a synthetic corpus and times each phase of a build.
+# to run:
+#   python CCBenchmark.py [options] [-o results.json] [--compare previous.json]
+#   python CCBenchmark.py --startup [-n REPEAT] [-o results.json] [--compare previous.json]
+
+characters = [("Lea", ["SMILE", "CHARMED", "NOD", "SHAKE", "DEFAULT"]), ("Apollo", ["CONTENT", "DEFAULT", "POINTING"]),
+    ("Emilie", ["CULTURE", "SUSPICIOUS", "EXHAUSTED"]), ("C'tron", ["DEFAULT", "NERVOUS"]), ("Joern", ["DEFAULT"]),
+    ("Sergey (avatar)", ["DEFAULT"])]
+words = ["justice", "duel", "again", "Spheromancer", "noble", "class", "battle", "cherie", "whoops", "nothing", "special", "I", "we", "should", "bet"]
+conditions = ["tmp.test", "tmp.leaSmile", "party.alive.Apollo", "plot.line >= 40000", "tmp.numTest2 > 3"]
+# the most each kind of startup may take on top of starting the interpreter itself, in seconds
+startupBudget = {"import": 0.05, "script": 0.1, "module": 0.1}
+
+
+class CorpusParameters:
+    def __init__(self, *, events: int = 200, messages: int = 4, lines: int = 8, depth: int = 2, density: float = 0.2,
+            files: int = 10, seed: int = 0) -> None:
+        # events in total, messages per event, lines per message and the depth ifs are nested up to
+        self.events: int = events
+        self.messages: int = messages
+        self.lines: int = lines
+        self.depth: int = depth
+        # the chance of any line being a set/label/goto instead of dialogue
+        self.density: float = density
+        self.files: int = files
+        self.seed: int = seed
+
+    def asDict(self) -> dict:
+        return {
+            "events": self.events,
+            "messages": self.messages,
+            "lines": self.lines,
+            "depth": self.depth,
+            "density": self.density,
+            "files": self.files,
+            "seed": self.seed
+        }
+
+
+def generateStep(rng: random.Random, params: CorpusParameters, labelCount: int) -> str:
+    if rng.random() >= params.density:
+        name, expressions = rng.choice(characters)
+        message = " ".join(rng.choices(words, k = rng.randint(3, 10)))
+        return f"{name} > {rng.choice(expressions)}: {message}"
+    match rng.randrange(5):
+        case 0: return f"set tmp.var{rng.randrange(20)} = {rng.choice(['true', 'false'])}"
+        case 1: return f"set tmp.num{rng.randrange(20)} {rng.choice('=+-*')} {rng.randrange(100)}"
+        case 2: return f"label L{labelCount}"
+        case 3: return f"goto L{rng.randrange(labelCount + 1)}"
+        case _: return f"goto L{rng.randrange(labelCount + 1)} if {rng.choice(conditions)}"
+
+def generateMessage(rng: random.Random, params: CorpusParameters, depth: int = 0) -> list[str]:
+    lines: list[str] = []
+    for i in range(params.lines):
+        lines.append("    " * depth + generateStep(rng, params, i))
+    # each block holds one nested if, until the maximum depth is reached.
+    # only some of them have an else block, which isn't nested any further.
+    if depth < params.depth:
+        indent = "    " * depth
+        lines.append(f"{indent}if {rng.choice(conditions)}")
+        lines += generateMessage(rng, params, depth + 1)
+        if rng.random() < 0.5:
+            lines.append(f"{indent}else")
+            lines += ["    " * (depth + 1) + generateStep(rng, params, i) for i in range(params.lines)]
+        lines.append(f"{indent}endif")
+    return lines
+
+def generateEvent(rng: random.Random, params: CorpusParameters, title: str) -> list[str]:
+    lines: list[str] = [f"== {title} ==", "# generated event", "frequency: REGULAR", "repeat: ONCE",
+        f"condition: party.alive.{rng.choice(characters)[0]}", "type.killCount: 0", "type: BATTLE_OVER", ""]
+    for i in range(params.messages):
+        lines.append(f"Message {i + 1}")
+        lines += generateMessage(rng, params)
+        lines.append("")
+    return lines
+
+def generateCorpus(directory: str, params: CorpusParameters) -> list[str]:
+    # the same parameters always produce the same files.
+    rng = random.Random(params.seed)
+    os.makedirs(directory, exist_ok = True)
+    filenames: list[str] = []
+    for fileNumber in range(params.files):
+        # events are spread as evenly as possible between the files
+        eventRange = range(params.events * fileNumber // params.files, params.events * (fileNumber + 1) // params.files)
+        lines: list[str] = []
+        for eventNumber in eventRange:
+            lines += generateEvent(rng, params, f"bench-{eventNumber}")
+        filename = os.path.join(directory, f"bench-{fileNumber}.cces")
+        with open(filename, "w", encoding = "utf8") as corpusFile:
+            corpusFile.write("\n".join(lines))
+        filenames.append(filename)
+    return filenames
+
+
+def timePhase(function, repeat: int) -> tuple[float, object]:
+    # the fastest run is the least affected by anything else running at the time
+    best: float = float("inf")
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+def splitEvents(filenames: list[str]) -> list[list[Parser.Token]]:
+    # the tokens of each event, without their titles
+    eventTokens: list[list[Parser.Token]] = []
+    for filename in filenames:
+        with open(filename, "r", encoding = "utf8") as inputFile:
+            for token in Parser.tokenize(inputFile.read()):
+                if token.tokenType is TokenType.TITLE: eventTokens.append([])
+                elif eventTokens: eventTokens[-1].append(token)
+    return eventTokens
+
+def splitMessages(eventTokens: list[list[Parser.Token]]) -> list[list[Parser.Token]]:
+    messageTokens: list[list[Parser.Token]] = []
+    for tokens in eventTokens:
+        for token in tokens:
+            if token.tokenType is TokenType.EVENT_HEADER: messageTokens.append([])
+            elif messageTokens and token.tokenType is not TokenType.PROPERTY and token.tokenType is not TokenType.PROPERTY_TYPE:
+                messageTokens[-1].append(token)
+    return messageTokens
+
+def runBenchmark(params: CorpusParameters, repeat: int = 3) -> dict:
+    with tempfile.TemporaryDirectory() as workDirectory:
+        filenames = generateCorpus(os.path.join(workDirectory, "src"), params)
+        lineCount: int = 0
+        for filename in filenames:
+            with open(filename, "r", encoding = "utf8") as inputFile:
+                lineCount += sum(1 for _ in inputFile)
+
+        eventTokens = splitEvents(filenames)
+        messageTokens = splitMessages(eventTokens)
+        phases: dict[str, float] = {}
+        phases["parseFiles"], events = timePhase(lambda: Parser.parseFiles(filenames), repeat)
+        phases["handleEvent"], _ = timePhase(lambda: [Parser.handleEvent(tokens) for tokens in eventTokens], repeat)
+        phases["processEvents"], _ = timePhase(lambda: [Parser.processEvents(tokens) for tokens in messageTokens], repeat)
+        phases["generatePatchFile"], _ = timePhase(lambda: Parser.generatePatchFile(events), repeat)
+
+        # every run writes into an empty directory, so that no output is skipped as unchanged
+        workingDirectory = os.getcwd()
+        writeTimes: list[float] = []
+        try:
+            for run in range(repeat):
+                outputDirectory = os.path.join(workDirectory, f"out{run}")
+                os.makedirs(outputDirectory)
+                os.chdir(outputDirectory)
+                writeTimes.append(timePhase(lambda: Parser.writeEventFiles(events), 1)[0])
+        finally:
+            os.chdir(workingDirectory)
+        phases["writeEventFiles"] = min(writeTimes)
+
+    return {
+        "parserVersion": Parser.parserVersion,
+        "python": platform.python_version(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "parameters": params.asDict(),
+        "lines": lineCount,
+        "events": len(eventTokens),
+        "phases": {
+            name: {
+                "seconds": seconds,
+                "linesPerSecond": lineCount / seconds if seconds else None,
+                "eventsPerSecond": len(eventTokens) / seconds if seconds else None
+            } for name, seconds in phases.items()
+        }
+    }
+
+def runStartupBenchmark(repeat: int = 10) -> dict:
+    # every run starts a new interpreter, so nothing has been imported yet. bytecode is allowed to be cached,
+    # as it would be for anyone running the parser more than once.
+    root = os.path.dirname(os.path.abspath(__file__))
+    environment = dict(os.environ, PYTHONPATH = root)
+    environment.pop("PYTHONDONTWRITEBYTECODE", None)
+    commands = {
+        "interpreter": [sys.executable, "-c", "pass"],
+        "import": [sys.executable, "-c", "import cc_eventscript_parser"],
+        # the same build run as a script, which is compiled every time, and as a module, which isn't
+        "script": [sys.executable, os.path.join(root, "cc_eventscript_parser.py"), os.path.join(root, "example.cces")],
+        "module": [sys.executable, "-m", "cc_eventscript_parser", os.path.join(root, "example.cces")],
+    }
+    times: dict[str, float] = {}
+    with tempfile.TemporaryDirectory() as workDirectory:
+        for name, command in commands.items():
+            run = lambda: subprocess.run(command, cwd = workDirectory, env = environment, stdout = subprocess.DEVNULL, check = True)
+            run()
+            times[name], _ = timePhase(run, repeat)
+    return {
+        "parserVersion": Parser.parserVersion,
+        "python": platform.python_version(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "startup": {
+            name: {
+                "seconds": seconds,
+                "overInterpreter": seconds - times["interpreter"] if name != "interpreter" else None
+            } for name, seconds in times.items()
+        }
+    }
+
+def printStartupResults(results: dict, previous: dict | None = None) -> bool:
+    # returns whether every kind of startup was within its budget
+    withinBudget = True
+    for name, entry in results["startup"].items():
+        line = f"{name:>12}: {entry['seconds'] * 1000:8.2f} ms"
+        if entry["overInterpreter"] is not None:
+            line += f" ({entry['overInterpreter'] * 1000:+.2f} ms, budget {startupBudget[name] * 1000:.0f} ms)"
+            if entry["overInterpreter"] > startupBudget[name]:
+                line += " over budget!"
+                withinBudget = False
+        if previous is not None and name in previous.get("startup", {}) and entry["seconds"]:
+            line += f"  ({previous['startup'][name]['seconds'] / entry['seconds']:.2f}x)"
+        print(line)
+    return withinBudget
+
+def printResults(results: dict, previous: dict | None = None) -> None:
+    print(f"{results['lines']} lines, {results['events']} events")
+    for name, phase in results["phases"].items():
+        line = f"{name:>18}: {phase['seconds'] * 1000:9.2f} ms {phase['linesPerSecond'] or 0:12.0f} lines/s {phase['eventsPerSecond'] or 0:10.0f} events/s"
+        if previous is not None and name in previous["phases"] and phase["seconds"]:
+            line += f"  ({previous['phases'][name]['seconds'] / phase['seconds']:.2f}x)"
+        print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Benchmark the cc-eventscript parser on a generated corpus.")
+    parser.add_argument("-e", "--events", type = int, default = 200, help = "the number of events to generate")
+    parser.add_argument("-m", "--messages", type = int, default = 4, help = "the number of messages per event")
+    parser.add_argument("-l", "--lines", type = int, default = 8, help = "the number of lines per message, and per nested block")
+    parser.add_argument("-d", "--depth", type = int, default = 2, help = "the depth if statements are nested up to")
+    parser.add_argument("--density", type = float, default = 0.2, help = "the chance of a line being a set/label/goto instead of dialogue")
+    parser.add_argument("-f", "--files", type = int, default = 10, help = "the number of files to spread the events across")
+    parser.add_argument("-s", "--seed", type = int, default = 0, help = "the seed of the generated corpus")
+    parser.add_argument("-n", "--repeat", type = int, default = None, help = "the number of times each phase is run, 3 by default or 10 with --startup. the fastest run is reported")
+    parser.add_argument("-o", "--output", default = None, metavar = "FILE", help = "save the results as JSON")
+    parser.add_argument("--compare", default = None, metavar = "FILE", help = "compare against results saved by an earlier run")
+    parser.add_argument("--generate", default = None, metavar = "DIRECTORY", help = "only write the generated corpus to a directory")
+    parser.add_argument("--startup", action = "store_true", help = "time importing the parser and building a small file in a new interpreter instead, and fail if any is over budget")
+    args = parser.parse_args()
+
+    params = CorpusParameters(events = args.events, messages = args.messages, lines = args.lines, depth = args.depth,
+        density = args.density, files = args.files, seed = args.seed)
+    if args.generate:
+        for filename in generateCorpus(args.generate, params): print(filename)
+        sys.exit()
+
+    previous = None
+    if args.compare:
+        with open(args.compare, "r", encoding = "utf8") as previousFile:
+            previous = json.load(previousFile)
+
+    withinBudget = True
+    if args.startup:
+        results = runStartupBenchmark(args.repeat or 10)
+        withinBudget = printStartupResults(results, previous)
+    else:
+        results = runBenchmark(params, args.repeat or 3)
+        printResults(results, previous)
+    if args.output:
+        with open(args.output, "w+", encoding = "utf8") as outputFile:
+            json.dump(results, outputFile, indent = 4)
+    sys.exit(0 if withinBudget else 1)
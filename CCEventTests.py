@@ -1,4 +1,5 @@
-import json
+import io, json
+from collections.abc import Iterator
 import CCEvents as Events
 from CCUtils import Character
 
@@ -16,6 +17,18 @@ def testEvent(input: Events.Event_Step, expectedOutput: dict) -> bool:
         print(json.dumps(input.asDict(), indent=2))
         return False
 
+def testValue(received, expected) -> bool:
+    # the same as testEvent, for anything that isn't a step
+    if received == expected:
+        print("Test passed!")
+        return True
+    print("Test failed!")
+    print("Expected:")
+    print(expected)
+    print("Received:")
+    print(received)
+    return False
+
 print("Testing SHOW_SIDE_MSG")
 event = Events.SHOW_SIDE_MSG(Character("Emilie", "EXHAUSTED"), "Uhm...\\. whoops...")
 testEvent(event, 
@@ -55,3 +68,364 @@ testEvent(event,
     "value": 3
 })
 
+
+print("Testing SELECT_RANDOM")
+event = Events.SELECT_RANDOM()
+event.options.append(Events.RandomChoice(2, "true"))
+event.options[0].events.append(Events.LABEL("x"))
+testEvent(event, {
+    "type": "SELECT_RANDOM",
+    "options": [{"0": " ", "count": 1, "weight": 2}],
+    "0_0": [{"type": "LABEL", "name": "x"}]
+})
+testValue("".join(Events.iterEncode(event, 2)), json.dumps(event.asDict(), indent = 2))
+
+
+print("Testing nested IF")
+from cc_eventscript_parser import handleEvent, tokenize
+event = handleEvent(list(tokenize("""Message 1
+if tmp.a
+    if tmp.b
+        set tmp.c = true
+    else
+        set tmp.c + 1
+    endif
+endif""")))
+testEvent(event.event[1], 
+{
+    "type": "IF",
+    "withElse": False,
+    "condition": "call.runCount == 1",
+    "thenStep": [{
+        "type": "IF",
+        "withElse": False,
+        "condition": "tmp.a",
+        "thenStep": [{
+            "type": "IF",
+            "withElse": True,
+            "condition": "tmp.b",
+            "thenStep": [{"type": "CHANGE_VAR_BOOL", "varName": "tmp.c", "value": True, "changeType": "set"}],
+            "elseStep": [{"type": "CHANGE_VAR_NUMBER", "varName": "tmp.c", "value": 1, "changeType": "add"}]
+        }]
+    }]
+})
+
+
+print("Testing in-memory compile")
+from cc_eventscript_parser import compileSource
+result = compileSource(["== test ==", "Message 1", "set tmp.a = true"])
+testEvent(result.commonEvents["test"].event[1].thenStep[0], {"type": "CHANGE_VAR_BOOL", "varName": "tmp.a", "value": True, "changeType": "set"})
+testValue(json.loads(result.eventJson["test"])["test"]["runOnTrigger"], [1])
+testValue(result.patch[1], {"type": "IMPORT", "src": "mod:patches/test.json"})
+# a bundled patch sets each event itself rather than importing its file, but keeps other imports
+result = compileSource("import other\n== a ==\nMessage 1\nLea > SMILE: hi")
+testValue([(step["type"], step.get("src", step.get("index"))) for step in result.bundledPatch],
+    [("ENTER", "commonEvents"), ("IMPORT", "mod:patches/other.json"), ("SET_KEY", "a"), ("EXIT", None)])
+testValue(result.bundledPatch[2]["content"], json.loads(result.eventJson["a"])["a"])
+
+
+print("Testing shared steps")
+interner = Events.StepInterner()
+steps = interner.internSteps([Events.IF("tmp.a", thenEvent = [Events.LABEL("x")], elseEvent = []) for _ in range(2)])
+testValue((steps[0] is steps[1], interner.isShared(steps[0])), (True, True))
+testValue("".join(Events.iterEncode(steps, 2, interner = interner)), json.dumps([step.asDict() for step in steps], indent = 2))
+
+
+print("Testing cached forms")
+event = Events.CommonEvent(type = {}, loopCount = 3, events = [Events.IF("tmp.a", thenEvent = [Events.LABEL("x")])])
+eventDict = event.asDict()
+testValue(event.toJson(2), json.dumps(eventDict, indent = 2))
+# the dict belongs to the caller, so changing it doesn't change the event
+eventDict["event"][0]["condition"] = "tmp.b"
+testValue(json.loads(event.toJson())["event"][0]["condition"], "tmp.a")
+# even an empty list of steps is copied rather than shared with the step
+emptyStep = Events.IF("tmp.a")
+emptyStep.asDict()["thenStep"].append({"type": "LABEL", "name": "x"})
+testValue((emptyStep.keptDict()["thenStep"] is emptyStep.thenStep, emptyStep.thenStep, emptyStep.asDict()["thenStep"]), (False, [], []))
+# assigning to a field is noticed by everything holding the step, even when more than one thing does
+label = event.event[1].thenStep[0]
+otherStep = Events.IF("tmp.c", thenEvent = [label])
+otherStep.toJson()
+label.name = "y"
+testValue((json.loads(event.toJson())["event"][0]["thenStep"][0]["name"], otherStep.asDict()["thenStep"][0]["name"]), ("y", "y"))
+# a list changed in place isn't, until invalidate is called
+otherStep.thenStep.append(Events.LABEL("z"))
+otherStep.invalidate()
+testValue(otherStep.toJson(2), json.dumps(otherStep.asDict(), indent = 2))
+testEvent(otherStep, {"type": "IF", "withElse": False, "condition": "tmp.c", "thenStep": [{"type": "LABEL", "name": "y"}, {"type": "LABEL", "name": "z"}]})
+# a step sent to another process leaves its kept forms, and whatever holds it, behind
+import pickle
+pickledStep = pickle.loads(pickle.dumps(otherStep))
+testValue((pickledStep._json, pickledStep.thenStep[0]._parents, pickledStep.toJson(2)), (None, None, otherStep.toJson(2)))
+# steps can be nested far deeper than the interpreter's recursion limit
+deepStep = Events.LABEL("x")
+for _ in range(1500): deepStep = Events.IF("tmp.a", thenEvent = [deepStep])
+testValue(len(deepStep.toJson()), len("".join(Events.iterEncode(deepStep))))
+
+
+print("Testing default step lists")
+# steps made without any given steps must not share a list
+first, second = Events.IF("tmp.a"), Events.IF("tmp.b")
+first.thenStep.append(Events.LABEL("x"))
+first.elseStep.append(Events.LABEL("y"))
+testValue((second.thenStep, second.elseStep), ([], []))
+firstEvent, secondEvent = Events.CommonEvent(type = {}, loopCount = 3), Events.CommonEvent(type = {}, loopCount = 3)
+firstEvent.event[1] = first
+testValue(secondEvent.event, {})
+
+
+print("Testing interned characters")
+character = Character.intern("Lea", "SMILE")
+testValue(Character.intern("Lea", "SMILE") is character, True)
+# characters no event holds any more are dropped from the table
+del character
+testValue(("Lea", "SMILE") in Character._interned, False)
+
+
+print("Testing diagnostics")
+import cc_eventscript_parser as Parser
+Parser.diagnostics = Parser.Diagnostics()
+Parser.parseSource("== test ==\nMessage 1\nendif\nif tmp.a\nelse\nelse\nMessage 2\niff tmp.b", "test.cces")
+testValue([(entry["severity"], entry["line"], entry["messageNumber"]) for entry in Parser.diagnostics.entries],
+    [("error", 3, 1), ("error", 6, 1), ("error", 4, 1), ("warning", 8, 2)])
+Parser.diagnostics = None
+# sources parsed at the same time each report to their own diagnostics, as nothing is set on the module
+import sys, threading
+sourceDiagnostics = {filename: Parser.Diagnostics() for filename in ("a.cces", "b.cces")}
+threads = [threading.Thread(target = Parser.parseSource, args = ("== test ==\nMessage 1\nendif\n" * 500, filename),
+    kwargs = {"diagnostics": fileDiagnostics}) for filename, fileDiagnostics in sourceDiagnostics.items()]
+# the threads are switched between often, so their parsing is interleaved
+switchInterval = sys.getswitchinterval()
+sys.setswitchinterval(1e-5)
+for thread in threads: thread.start()
+for thread in threads: thread.join()
+sys.setswitchinterval(switchInterval)
+testValue({filename: (len(fileDiagnostics.entries), {entry["file"] for entry in fileDiagnostics.entries}) for filename, fileDiagnostics in sourceDiagnostics.items()},
+    {"a.cces": (500, {"a.cces"}), "b.cces": (500, {"b.cces"})})
+testValue(Parser.diagnostics, None)
+
+
+print("Testing events handed over while building")
+import os, tempfile
+with tempfile.TemporaryDirectory() as directory:
+    filename = os.path.join(directory, "test.cces")
+    with open(filename, "w", encoding = "utf8") as inputFile:
+        inputFile.write("== good ==\nMessage 1\nLea > SMILE: hi\n== bad ==\nMessage 1\nendif")
+    # nothing is handed over for a file with an error, even the events before it
+    handedOver = []
+    try:
+        Parser.parseFiles([filename], onEvent = lambda eventTitle, item: handedOver.append(eventTitle))
+    except Exception:
+        pass
+    testValue(handedOver, [])
+
+
+print("Testing sharded builds")
+import CCShards
+
+def raisedError(function) -> str:
+    # the type and message of the error raised by the function and each of its causes
+    try:
+        function()
+    except Exception as e:
+        chain = []
+        while e is not None:
+            chain.append(f"{type(e).__name__}: {e}")
+            e = e.__cause__
+        return " <- ".join(chain)
+    return "no error"
+
+def writeInputs(directory: str, texts: dict[str, str]) -> list[str]:
+    filenames = []
+    for name, text in texts.items():
+        filenames.append(os.path.join(directory, name))
+        with open(filenames[-1], "w", encoding = "utf8") as inputFile:
+            inputFile.write(text)
+    return filenames
+
+with tempfile.TemporaryDirectory() as directory:
+    # the merge gives the error a single build would, even when later shards both have the same event
+    filenames = writeInputs(directory, {"a.cces": "== a ==\nMessage 1\nendif", "b.cces": "== same ==\nMessage 1\nLea > SMILE: hi",
+        "c.cces": "== same ==\nMessage 1\nLea > SMILE: hi"})
+    for files in (filenames, filenames[1:]):
+        testValue(raisedError(lambda: CCShards.mergeManifests([Parser.buildShard(files, index, len(files))[0] for index in range(1, len(files) + 1)])),
+            raisedError(lambda: Parser.parseFiles(files)))
+    # shards given the same number of files, but not the same files, are from different builds
+    testValue(raisedError(lambda: CCShards.mergeManifests([Parser.buildShard(filenames, 1, 2)[0], Parser.buildShard(filenames[::-1], 2, 2)[0]])),
+        "CCES_Exception: Error: shard 2 is from a different build")
+
+
+print("Testing output written only when changed")
+with tempfile.TemporaryDirectory() as directory:
+    filename = os.path.join(directory, "test.json")
+    testValue(Parser.writeIfChanged(filename, "{}\n"), True)
+    # the same text isn't written again, however it's split up, so the file keeps its modification time
+    os.utime(filename, ns = (0, 0))
+    testValue((Parser.writeIfChanged(filename, ["{", "}\n"]), os.stat(filename).st_mtime_ns), (False, 0))
+
+    def failingChunks() -> Iterator[str]:
+        yield "[]"
+        raise ValueError("stopped")
+
+    # a write that fails part way leaves the file as it was, and nothing else behind
+    batchSize, Parser.writeBatchSize = Parser.writeBatchSize, 1
+    testValue(raisedError(lambda: Parser.writeIfChanged(filename, failingChunks())), "ValueError: stopped")
+    Parser.writeBatchSize = batchSize
+    with open(filename, "r", encoding = "utf8") as outputFile:
+        testValue((outputFile.read(), os.listdir(directory)), ("{}\n", ["test.json"]))
+    # a temporary file this write didn't make is left alone, even though the write can't go ahead
+    tempFilename = f"{filename}.{os.getpid()}.tmp"
+    open(tempFilename, "w").close()
+    testValue((raisedError(lambda: Parser.writeIfChanged(filename, "[]")).split(":")[0], os.path.exists(tempFilename)), ("FileExistsError", True))
+
+print("Testing finding input files")
+with tempfile.TemporaryDirectory() as directory:
+    for name in ("b.cces", "a/c.cces", "a/d.txt", "drafts/e.cces", "!f.cces"):
+        os.makedirs(os.path.join(directory, os.path.dirname(name)), exist_ok = True)
+        with open(os.path.join(directory, name), "w", encoding = "utf8") as inputFile:
+            inputFile.write(f"== {os.path.basename(name)[:-5]} ==\nMessage 1\nLea > SMILE: hi")
+
+    def foundFiles(include: list[str] | None = None, exclude: list[str] | None = None) -> list[str]:
+        return [os.path.relpath(path, directory).replace(os.sep, "/") for path in Parser.findInputFiles([directory], True, include, exclude)]
+
+    # files are found in name order, and those starting with "!" are skipped
+    testValue(foundFiles(), ["a/c.cces", "b.cces", "drafts/e.cces"])
+    # patterns match the path within the directory, and an excluded directory isn't searched at all
+    testValue(foundFiles(["*.txt", "b.*"], ["drafts"]), ["a/d.txt", "b.cces"])
+    testValue(foundFiles(exclude = ["a/*", "*/e.cces"]), ["b.cces"])
+    # a build given the same patterns parses the same files
+    testValue(list(Parser.parseFiles([directory], True, include = ["*.cces"], exclude = ["a/*", "*/e.cces"])), ["b"])
+
+print("Testing the build cache")
+with tempfile.TemporaryDirectory() as directory:
+    workingDirectory = os.getcwd()
+    os.chdir(directory)
+    try:
+        filenames = writeInputs(directory, {"a.cces": "== a ==\nMessage 1\nLea > SMILE: hi\n== b ==\nMessage 1\nLea > SMILE: hi",
+            "c.cces": "== c ==\nMessage 1\nLea > SMILE: hi"})
+
+        def cachedBuild() -> tuple[tuple[int, int], list[str]]:
+            # the files written and skipped, and the events that were parsed
+            cache = Parser.BuildCache("cache.json")
+            events = Parser.parseFiles(filenames, cache = cache)
+            written = Parser.writeEventFiles(events, None, cache)
+            cache.save()
+            return written, [eventTitle for eventTitle, item in events.items() if item.event is not None]
+
+        testValue(cachedBuild(), ((3, 0), ["a", "b", "c"]))
+        testValue(cachedBuild(), ((0, 0), []))
+        # only the event that changed is parsed and written again, even though the rest of its file is read
+        writeInputs(directory, {"a.cces": "== a ==\nMessage 1\nLea > SMILE: hi\n== b ==\nMessage 1\nLea > SMILE: bye"})
+        testValue(cachedBuild(), ((1, 0), ["b"]))
+        # a cache from another version of the parser is ignored, though the output is the same
+        Parser.cacheVersion += 1
+        testValue(cachedBuild(), ((0, 3), ["a", "b", "c"]))
+        Parser.cacheVersion -= 1
+    finally:
+        os.chdir(workingDirectory)
+
+print("Testing shared steps with worker processes")
+with tempfile.TemporaryDirectory() as directory:
+    filenames = writeInputs(directory, {"a.cces": "== a ==\nMessage 1\nset tmp.a = true", "b.cces": "== b ==\nMessage 1\nset tmp.a = true"})
+    # steps parsed by the workers are shared just as those of a serial build are
+    for jobs in (1, 2):
+        Parser.interner = Events.StepInterner()
+        events = Parser.parseFiles(filenames, jobs = jobs)
+        steps = [events[eventTitle].event.event[1].thenStep[0] for eventTitle in ("a", "b")]
+        testValue((steps[0] is steps[1], Parser.interner.isShared(steps[0])), (True, True))
+    Parser.interner = None
+
+print("Testing event selection")
+# the bodies of events that aren't selected are skipped without being parsed, so their errors aren't found
+selection = Parser.EventSelection(["a*", "quests.*"], ["ab"])
+items, error = Parser.parseSource("== a ==\nMessage 1\nLea > SMILE: hi\n== ab ==\nMessage 1\nendif\n== quests/b ==\nMessage 1\nLea > SMILE: hi\n"
+    "== c ==\nMessage 1\nendif", "test.cces", selection = selection)
+testValue((error, [(eventTitle, item.selected, item.event is not None) for eventTitle, item in items]),
+    (None, [("a", True, True), ("ab", False, False), ("quests.b", True, True), ("c", False, False)]))
+# every event is still imported by the patch
+testValue([step["src"] for step in Parser.generatePatchFile(dict(items))[1:-1]],
+    ["mod:patches/a.json", "mod:patches/ab.json", "mod:patches/quests.b.json", "mod:patches/c.json"])
+
+print("Testing tokenizing line by line")
+text = "== test == # comment\nMessage 1\n\nLea > SMILE: hi // comment\nset tmp.a = true"
+testValue([(token.tokenType, token.lineNumber, token.line) for token in tokenize(io.StringIO(text))],
+    [(token.tokenType, token.lineNumber, token.line) for token in tokenize(text)])
+# the profiler counts the lexer's own matches
+profiler = Parser.BuildProfiler()
+list(tokenize(text + "\n== !ignored ==\nsomething", onMatch = profiler.countMatch))
+testValue((profiler.patterns, profiler.tokens),
+    ({"header": [2, 2], "message": [3, 3], "skipped": [1, 0]}, {"TITLE": 2, "EVENT_HEADER": 1, "DIALOGUE": 1, "SET_VAR_BOOL": 1}))
+
+# the build hands its tokens to the symbol index, which reads property names without regard to case
+import CCSymbolIndex
+fileTokens = []
+Parser.parseSource("== a ==\nCondition: tmp.x\nMessage 1\nset tmp.y = true", "a.cces", onTokens = lambda filename, tokens: fileTokens.extend(tokens))
+testValue([(kind.value, name, line) for kind, name, eventTitle, message, line in CCSymbolIndex.iterSymbols(fileTokens)],
+    [("read", "tmp.x", 2), ("set", "tmp.y", 4)])
+# messages are numbered in order, whatever their headers say, just as the diagnostics number them
+Parser.diagnostics = Parser.Diagnostics()
+text = "== a ==\nMessage 5\nset tmp.x = true\nMessage 2\nendif"
+Parser.parseSource(text, "a.cces")
+testValue([(name, message) for kind, name, eventTitle, message, line in CCSymbolIndex.iterSymbols(tokenize(text))] + [("endif", Parser.diagnostics.entries[0]["messageNumber"])],
+    [("tmp.x", 1), ("endif", 2)])
+Parser.diagnostics = None
+
+
+print("Testing optimization")
+import CCOptimizer
+event = handleEvent(list(tokenize("""Message 1
+if true
+    set tmp.a + 1
+else
+    set tmp.b = true
+endif
+set tmp.a + 2
+goto end
+set tmp.c = true
+label end""")), optimizer = CCOptimizer.StepOptimizer())
+testEvent(event.event[1],
+{
+    "type": "IF",
+    "withElse": False,
+    "condition": "call.runCount == 1",
+    "thenStep": [
+        {"type": "CHANGE_VAR_NUMBER", "varName": "tmp.a", "value": 3, "changeType": "add"},
+        {"type": "GOTO_LABEL", "name": "end"},
+        {"type": "LABEL", "name": "end"}
+    ]
+})
+# changes that cancel out are removed, and sizes are only measured when asked for
+optimizer = CCOptimizer.StepOptimizer()
+steps = optimizer.optimizeSteps([Events.CHANGE_VAR_NUMBER("tmp.a", 2, Events.ChangeVarType.ADD), Events.CHANGE_VAR_NUMBER("tmp.a", 2, Events.ChangeVarType.SUB),
+    Events.LABEL("x")])
+testValue(([step.asDict() for step in steps], optimizer.stats["mergedChanges"], optimizer.stats["bytesBefore"]), ([{"type": "LABEL", "name": "x"}], 1, 0))
+# an "if" with an empty branch is inverted rather than having a branch removed, and its size is measured again
+optimizer = CCOptimizer.StepOptimizer(measureSize = True)
+steps = [Events.IF("tmp.a", elseEvent = [Events.LABEL("x")])]
+sizeBefore = CCOptimizer.encodedSize(steps)
+steps = optimizer.optimizeSteps(steps)
+testValue(([step.asDict() for step in steps], optimizer.stats["removedBranches"], optimizer.stats["invertedConditions"]),
+    ([{"type": "IF", "withElse": False, "condition": "!(tmp.a)", "thenStep": [{"type": "LABEL", "name": "x"}]}], 0, 1))
+testValue((optimizer.stats["bytesBefore"], optimizer.stats["bytesAfter"]), (sizeBefore, CCOptimizer.encodedSize(steps)))
+
+
+print("Testing the language server")
+import CCLanguageServer
+document = CCLanguageServer.Document("file:///test.cces", "== a ==\nMessage 1\nLea > SMILE: hi\n== b ==\nMessage 1\nLea > SMILE: hi\n== c ==\nMessage 1\nLea > SMILE: hi")
+# only the block that was edited is parsed again
+document.applyChange({"range": {"start": {"line": 5, "character": 0}, "end": {"line": 5, "character": 0}}, "text": "endif\n"})
+testValue(document.parsedBlocks, 1)
+testValue([(diagnostic["range"]["start"]["line"], diagnostic["message"]) for diagnostic in document.diagnostics()],
+    [(5, "'endif' found outside of if block (event 'b', message 1)")])
+# renaming a title joins or splits blocks, and duplicates are found across them
+document.applyChange({"range": {"start": {"line": 7, "character": 3}, "end": {"line": 7, "character": 4}}, "text": "a"})
+testValue(document.diagnostics()[-1]["message"], "Duplicate event name found in input file. (event 'a')")
+testValue((document.preview(8), document.preview(1)["title"]), (None, "a"))
+output = io.BytesIO()
+server = CCLanguageServer.LanguageServer(io.BytesIO(), output)
+server.handle({"id": 1, "method": "cces/previewEvent", "params": {"textDocument": {"uri": "file:///missing.cces"}, "position": {"line": 0, "character": 0}}})
+testValue(json.loads(output.getvalue().partition(b"\r\n\r\n")[2])["error"]["message"], "Error: document 'file:///missing.cces' isn't open")
+# the server's settings are given to the parser with each block, rather than left set on the module
+server.on_initialize({"initializationOptions": {"optimize": True}})
+server.on_textDocument_didOpen({"textDocument": {"uri": "file:///test.cces", "text": "== a ==\nMessage 1\nif true\nendif\nendif"}})
+testValue((Parser.optimizer, Parser.diagnostics, server.optimizer.stats["messages"], len(server.document("file:///test.cces").diagnostics())), (None, None, 1, 1))
@@ -1,6 +1,7 @@
-from typing import Any, Literal
+from collections.abc import Iterator
 from CCUtils import Character
 from enum import Enum
+import json
 # a class composed of event types in CrossCode.
 
 class ChangeVarType(Enum):
@@ -14,176 +15,299 @@ class ChangeVarType(Enum):
     XOR = "xor"
 
 class RandomChoice:
+    __slots__ = ("events", "weight", "activeCondition")
+
     def __init__(self, weight: int, activeCondition: str) -> None:
         self.events: list[Event_Step] = []
         self.weight: int = weight
         self.activeCondition: str = activeCondition
 
-class Event_Step:
+_setSlot = object.__setattr__
+
+class _Cached:
+    # keeps the dict and JSON of a step or event once they've been made, the JSON for each indentation.
+    # assigning to any field forgets them, along with those of every step or event that holds this one,
+    # so a kept form is only ever checked for, never compared with the fields. lists of steps and
+    # RandomChoices are changed in place without any assignment, so invalidate has to be called after that.
+    __slots__ = ("_json", "_dict", "_parents")
+    # the fields that hold steps
+    stepFields: tuple[str, ...] = ()
+    # whether any of the values hold other steps
+    hasSubsteps: bool = False
+
+    def __init__(self) -> None:
+        # set around __setattr__, which only has to look after the fields
+        _setSlot(self, "_json", None)
+        _setSlot(self, "_dict", None)
+        # whatever holds this step and has kept its own forms: None, one parent, or a list of them
+        _setSlot(self, "_parents", None)
+
+    def __setattr__(self, name: str, value: object) -> None:
+        _setSlot(self, name, value)
+        if self._json is not None or self._dict is not None: self.invalidate()
+
+    def __getstate__(self) -> tuple[None, dict]:
+        # the kept forms, and with them everything holding the step, aren't pickled along with it
+        return None, {slot: getattr(self, slot) for slot in _slotsOf(type(self))}
+
+    def __setstate__(self, state: tuple[None, dict]) -> None:
+        _Cached.__init__(self)
+        for name, value in state[1].items(): _setSlot(self, name, value)
+
+    def invalidate(self) -> None:
+        # a step without kept forms can't be part of any, as whatever holds a step keeps its forms
+        # only along with those of the step itself
+        pending: list[_Cached] = [self]
+        while pending:
+            node = pending.pop()
+            if node._json is None and node._dict is None: continue
+            _setSlot(node, "_json", None)
+            _setSlot(node, "_dict", None)
+            parents = node._parents
+            _setSlot(node, "_parents", None)
+            if isinstance(parents, list): pending += parents
+            elif parents is not None: pending.append(parents)
+
+    def _addParent(self, parent: "_Cached") -> None:
+        parents = self._parents
+        if parents is None: _setSlot(self, "_parents", parent)
+        elif isinstance(parents, list):
+            if parent not in parents: parents.append(parent)
+        elif parents is not parent: _setSlot(self, "_parents", [parents, parent])
+
+    def _adoptHeldSteps(self) -> None:
+        if not self.hasSubsteps: return
+        for step in self.heldSteps(): step._addParent(self)
+
+    def heldSteps(self) -> Iterator["Event_Step"]:
+        for name in self.stepFields:
+            steps = getattr(self, name)
+            yield from steps.values() if isinstance(steps, dict) else steps
+
+    def jsonItems(self) -> Iterator[tuple[str, object]]:
+        return iter(())
+
+    def keptDict(self) -> dict:
+        # the dict that's kept, which is shared with the dicts kept by everything holding this step,
+        # so it must not be modified. loops rather than comprehensions keep the recursion shallow.
+        if self._dict is None:
+            result = {}
+            for key, value in self.jsonItems(): result[key] = _asDictValue(value)
+            _setSlot(self, "_dict", result)
+            self._adoptHeldSteps()
+        return self._dict
+
     def asDict(self) -> dict:
-        return {"type": type(self).__name__}
+        # a copy of the kept dict, so the caller is free to modify it
+        return _copyValue(self.keptDict())
+
+    def toJson(self, indentation: int | None = None) -> str:
+        # the same text as json.dumps(self.asDict(), indent = indentation)
+        text = None if self._json is None else self._json.get(indentation)
+        if text is None: text = "".join(iterEncode(self, indentation, cached = True))
+        return text
+
+    def _keepJson(self, indentation: int | None, text: str) -> None:
+        if self._json is None: _setSlot(self, "_json", {})
+        self._json[indentation] = text
+        self._adoptHeldSteps()
+
+
+class Event_Step(_Cached):
+    # steps are created for every line of every event, so none of them carry a __dict__.
+    __slots__ = ()
+
+    # the key/value pairs of the step's JSON form, in order. 
+    # subclasses add their own after those of their parent class.
+    def jsonItems(self) -> Iterator[tuple[str, object]]:
+        yield "type", type(self).__name__
+
+    def internKey(self) -> tuple | None:
+        # steps with the same key are interchangeable. the steps held by a step are compared by identity,
+        # so they have to be interned first.
+        key: list = [type(self)]
+        for slot in _slotsOf(type(self)):
+            value = getattr(self, slot)
+            if isinstance(value, list): value = tuple(map(id, value))
+            key += (type(value), value)
+        return tuple(key)
 
 class _ChangeVar(Event_Step):
-    def __init__(self, varName: str, value: Any, changeType: ChangeVarType) -> None:
+    __slots__ = ("varName", "value", "changeType")
+
+    def __init__(self, varName: str, value: object, changeType: ChangeVarType) -> None:
         super().__init__()
         self.varName: str= varName
-        self.value: Any = value
+        self.value: object = value
         self.changeType: ChangeVarType = changeType
 
-    def asDict(self) -> dict:
-        return super().asDict() | {
-            "varName": self.varName,
-            "value": self.value,
-            "changeType": self.changeType.value
-        }
+    def jsonItems(self) -> Iterator[tuple[str, object]]:
+        yield from super().jsonItems()
+        yield "varName", self.varName
+        yield "value", self.value
+        yield "changeType", self.changeType.value
 
 class _Message(Event_Step):
+    __slots__ = ("character", "message")
+
     def __init__(self, character: Character, message: str) -> None:
         super().__init__()
         self.character: Character = character
         self.message: str = message
     
-    def asDict(self) -> dict:
-        return super().asDict() | {
-            "message": {
-                "en_US": self.message
-            },
-            "person": self.character.toPersonDict()
-        }
+    def jsonItems(self) -> Iterator[tuple[str, object]]:
+        yield from super().jsonItems()
+        yield "message", {"en_US": self.message}
+        yield "person", self.character.toPersonDict()
 
 
 
 class CHANGE_VAR_BOOL(_ChangeVar):
+    __slots__ = ()
+
     def __init__(self, varName: str, value: bool, changeType: ChangeVarType = ChangeVarType.SET) -> None:
         super().__init__(varName, value, changeType)
 
 class CHANGE_VAR_NUMBER(_ChangeVar):
+    __slots__ = ()
+
     def __init__(self, varName: str, value: int, changeType: ChangeVarType) -> None:
         super().__init__(varName, value, changeType)
 
 class SHOW_SIDE_MSG(_Message):
+    __slots__ = ()
+
     def __init__(self, character: Character, message: str) -> None:
         super().__init__(character, message)
 
 class SHOW_MSG(_Message):
+    __slots__ = ("autoContinue",)
+
     def __init__(self, character: Character, message: str, autoContinue: bool = False) -> None:
         super().__init__(character, message)
         self.autoContinue: bool = autoContinue
     
-    def asDict(self) -> dict:
-        return super().asDict() | {"autoContinue": self.autoContinue}
+    def jsonItems(self) -> Iterator[tuple[str, object]]:
+        yield from super().jsonItems()
+        yield "autoContinue", self.autoContinue
 
 class IF(Event_Step):
-    def __init__(self, condition: str, *, thenEvent: list[Event_Step] = [], elseEvent: list[Event_Step] = []) -> None:
+    __slots__ = ("condition", "thenStep", "elseStep")
+    hasSubsteps: bool = True
+    stepFields: tuple[str, ...] = ("thenStep", "elseStep")
+
+    def __init__(self, condition: str, *, thenEvent: list[Event_Step] | None = None, elseEvent: list[Event_Step] | None = None) -> None:
         super().__init__()
         self.condition: str = condition
-        self.thenStep: list[Event_Step] = thenEvent
-        self.elseStep: list[Event_Step] = elseEvent
+        self.thenStep: list[Event_Step] = thenEvent if thenEvent is not None else []
+        self.elseStep: list[Event_Step] = elseEvent if elseEvent is not None else []
     
     @property
     def withElse(self) -> bool: return len(self.elseStep) > 0
 
-    def asDict(self) -> dict:        
-        if self.withElse:
-            return super().asDict() | {
-                "withElse": self.withElse,
-                "condition": self.condition,
-                "thenStep": [event.asDict() for event in self.thenStep],
-                "elseStep": [event.asDict() for event in self.elseStep]
-            }
-        else:
-            return super().asDict() | {
-                "withElse": self.withElse,
-                "condition": self.condition,
-                "thenStep": [event.asDict() for event in self.thenStep],
-            }
+    def jsonItems(self) -> Iterator[tuple[str, object]]:
+        yield from super().jsonItems()
+        yield "withElse", self.withElse
+        yield "condition", self.condition
+        yield "thenStep", self.thenStep
+        if self.withElse: yield "elseStep", self.elseStep
 
 class WAIT(Event_Step):
+    __slots__ = ("time", "ignoreSlowdown")
+
     def __init__(self, time: float, ignoreSlowdown: bool = False) -> None:
         super().__init__()
         self.time: float = float(time)
         self.ignoreSlowdown: bool = ignoreSlowdown
 
-    def asDict(self) -> dict:
-        return super().asDict() | {
-            "time": self.time,
-            "ignoreSlowDown": self.ignoreSlowdown
-        }
+    def jsonItems(self) -> Iterator[tuple[str, object]]:
+        yield from super().jsonItems()
+        yield "time", self.time
+        yield "ignoreSlowDown", self.ignoreSlowdown
 
 class ADD_MSG_PERSON(Event_Step):
+    __slots__ = ("character", "side", "clearSide", "customName", "order")
+
     def __init__(self, character: Character, side: str, clearSide: bool = False, order: int = 0, customName: str = None) -> None:
         super().__init__()
         self.character: Character = character
-        self.side: Literal["LEFT", "RIGHT"] = side
+        # "LEFT" or "RIGHT"
+        self.side: str = side
         self.clearSide: bool = clearSide
         self.customName: str = customName
         self.order: int = order
 
-    def asDict(self) -> dict:
-        return super().asDict() | {
-            "side": self.side,
-            "order": self.order,
-            "clearSide": self.clearSide,
-            "person": self.character.toPersonDict()
-        } | {"name": {"en_US": self.customName}} if self.customName is not None else {}
+    def jsonItems(self) -> Iterator[tuple[str, object]]:
+        yield from super().jsonItems()
+        yield "side", self.side
+        yield "order", self.order
+        yield "clearSide", self.clearSide
+        yield "person", self.character.toPersonDict()
+        if self.customName is not None: yield "name", {"en_US": self.customName}
 
 class SELECT_RANDOM(Event_Step):
+    __slots__ = ("options",)
+    hasSubsteps: bool = True
+
     def __init__(self) -> None:
         super().__init__()
         self.options: list[RandomChoice] = []
 
-    def asDict(self) -> dict:
-        events: dict[list[Event_Step]] = {}
-
-        for i in range(self.options):
-          for j in range(self.options[i].events):
-            events |= {f"{i}_{j}": [event.asDict() for event in self.options[i].events]}
-
-        return super().asDict() | {
-            "options": [
-                {
-                    "0": " ",
-                    "count": len(eventOption.events),
-                    "weight": eventOption.weight
-                } for eventOption in self.options
-            ]
-        } | events
+    def heldSteps(self) -> Iterator["Event_Step"]:
+        for option in self.options: yield from option.events
+
+    def jsonItems(self) -> Iterator[tuple[str, object]]:
+        yield from super().jsonItems()
+        yield "options", [{"0": " ", "count": len(option.events), "weight": option.weight} for option in self.options]
+        for i, option in enumerate(self.options):
+            for j in range(len(option.events)):
+                yield f"{i}_{j}", option.events
+
+    def internKey(self) -> None:
+        return None
 
 class LABEL(Event_Step):
+    __slots__ = ("name",)
+
     def __init__(self, labelName: str) -> None:
         super().__init__()
         self.name: str = labelName
     
-    def asDict(self) -> dict:
-        return super().asDict() | {
-            "name": self.name
-        }
+    def jsonItems(self) -> Iterator[tuple[str, object]]:
+        yield from super().jsonItems()
+        yield "name", self.name
 
 class GOTO_LABEL(Event_Step): 
+    __slots__ = ("name",)
+
     def __init__(self, labelName: str) -> None:
         super().__init__()
         self.name: str = labelName
     
-    def asDict(self) -> dict:
-        return super().asDict() | {
-            "name": self.name
-        }
+    def jsonItems(self) -> Iterator[tuple[str, object]]:
+        yield from super().jsonItems()
+        yield "name", self.name
 
 class GOTO_LABEL_WHILE(GOTO_LABEL): 
+    __slots__ = ("condition",)
+
     def __init__(self, labelName: str, condition: str) -> None:
         super().__init__(labelName)
         self.condition: str = condition
     
-    def asDict(self) -> dict:
-        return super().asDict() | {
-            "name": self.name,
-            "condition": self.condition
-        }
+    def jsonItems(self) -> Iterator[tuple[str, object]]:
+        yield from super().jsonItems()
+        yield "condition", self.condition
 
 
-class CommonEvent:
+class CommonEvent(_Cached):
+    __slots__ = ("frequency", "repeat", "condition", "eventType", "type", "loopCount", "overrideSideMessage", "event")
+    stepFields: tuple[str, ...] = ("event",)
+    hasSubsteps: bool = True
+
     def __init__(self, *, type: dict, loopCount: int, frequency: str = "REGULAR", repeat: str = "ONCE", condition: str = "true",  
-            eventType: str = "PARALLEL", overrideSideMessage: bool = False, events: dict[int, Event_Step] | list[Event_Step] = {}) -> None:
+            eventType: str = "PARALLEL", overrideSideMessage: bool = False, events: dict[int, Event_Step] | list[Event_Step] | None = None) -> None:
+        super().__init__()
         self.frequency: str = frequency
         self.repeat: str = repeat
         self.condition: str = condition
@@ -209,15 +333,171 @@ class CommonEvent:
     def runOnTrigger(self) -> list[int]:
         return list(self.event.keys())
 
-    def asDict(self):
-        return {
-            "frequency": self.frequency,
-            "repeat": self.repeat,
-            "condition": self.condition,
-            "eventType": self.eventType,
-            "runOnTrigger": self.runOnTrigger,
-            "event": [event.asDict() for event in self.event.values()],
-            "overrideSideMessage": self.overrideSideMessage,
-            "loopCount": self.loopCount,
-            "type": self.type
-        }
\ No newline at end of file
+    def jsonItems(self) -> Iterator[tuple[str, object]]:
+        yield "frequency", self.frequency
+        yield "repeat", self.repeat
+        yield "condition", self.condition
+        yield "eventType", self.eventType
+        yield "runOnTrigger", self.runOnTrigger
+        yield "event", list(self.event.values())
+        yield "overrideSideMessage", self.overrideSideMessage
+        yield "loopCount", self.loopCount
+        yield "type", self.type
+
+
+class StepInterner:
+    # shares a single instance between steps that are structurally identical, and has the JSON of
+    # those used more than once kept by the step, so it's only encoded once.
+    # interned steps are shared, so they must not be modified afterwards.
+    def __init__(self) -> None:
+        self.steps: dict[tuple, Event_Step] = {}
+        self.uses: dict[int, int] = {}
+
+    def intern(self, step: Event_Step) -> Event_Step:
+        key = step.internKey()
+        if key is None: return step
+        step = self.steps.setdefault(key, step)
+        self.uses[id(step)] = self.uses.get(id(step), 0) + 1
+        return step
+
+    def internSteps(self, steps: list[Event_Step]) -> list[Event_Step]:
+        # children are interned before their parents
+        for i, step in enumerate(steps):
+            if isinstance(step, IF):
+                step.thenStep = self.internSteps(step.thenStep)
+                step.elseStep = self.internSteps(step.elseStep)
+            steps[i] = self.intern(step)
+        return steps
+
+    def internEvent(self, event: "CommonEvent") -> "CommonEvent":
+        # interns the steps of each message, as they would have been while it was built
+        for message in event.event.values(): message.thenStep = self.internSteps(message.thenStep)
+        return event
+
+    def isShared(self, step: Event_Step) -> bool:
+        return self.uses.get(id(step), 0) > 1
+
+
+_slots: dict[type, tuple[str, ...]] = {}
+
+def _slotsOf(cls: type) -> tuple[str, ...]:
+    if cls not in _slots:
+        # the cached forms aren't fields
+        _slots[cls] = tuple(slot for base in reversed(cls.__mro__) for slot in getattr(base, "__slots__", ()) if not slot.startswith("_"))
+    return _slots[cls]
+
+def _asDictValue(value: object) -> object:
+    if isinstance(value, _Cached): return value.keptDict()
+    if isinstance(value, list) and value and isinstance(value[0], Event_Step):
+        steps = []
+        for step in value: steps.append(step.keptDict())
+        return steps
+    # fields like CommonEvent.type are copied too, so nothing kept is shared with the event
+    if isinstance(value, (dict, list)): return _copyValue(value)
+    return value
+
+def _copyValue(value: object) -> object:
+    if type(value) is dict:
+        result = {}
+        for key, item in value.items(): result[key] = _copyValue(item)
+        return result
+    if type(value) is list:
+        result = []
+        for item in value: result.append(_copyValue(item))
+        return result
+    return value
+
+def iterEncode(value: object, indentation: int | None = None, level: int = 0, interner: StepInterner | None = None,
+        cached: bool = False) -> Iterator[str]:
+    # produces the same text as json.dump, but straight from the steps, without building their dicts first.
+    # anything that doesn't contain steps is handed to json as a whole.
+    # when cached, the JSON each step and event keeps is used, and made and kept if it doesn't have it yet.
+    # with an interner, only that of shared steps is.
+    # nested values are worked through with a stack of generators rather than by recursion, so steps can
+    # be nested as deeply as memory allows.
+    stack: list[Iterator] = [iter((_encoded(value, indentation, level, interner, cached),))]
+    # for each step whose JSON is being made to be kept: the size of the stack when it was started,
+    # the step, the level its JSON is used at, and the chunks made so far
+    keeping: list[tuple[int, _Cached, int, list[str]]] = []
+    while stack:
+        for item in stack[-1]:
+            if isinstance(item, tuple):
+                step, stepLevel = item
+                text = None if step._json is None else step._json.get(indentation)
+                if text is None and step.hasSubsteps:
+                    # the step's JSON is made at level 0, and indented to where it's used once it's done
+                    keeping.append((len(stack), step, stepLevel, []))
+                    stack.append(_encodeItems(step.jsonItems(), indentation, 0, interner, True))
+                    break
+                if text is None:
+                    text = _encodePlain(dict(step.jsonItems()), indentation, 0)
+                    step._keepJson(indentation, text)
+                item = _indented(text, indentation, stepLevel)
+            elif not isinstance(item, str):
+                stack.append(item)
+                break
+            if keeping: keeping[-1][3].append(item)
+            else: yield item
+        else:
+            stack.pop()
+            if keeping and keeping[-1][0] == len(stack):
+                _, step, stepLevel, chunks = keeping.pop()
+                text = "".join(chunks)
+                step._keepJson(indentation, text)
+                text = _indented(text, indentation, stepLevel)
+                if keeping: keeping[-1][3].append(text)
+                else: yield text
+
+def _encoded(value: object, indentation: int | None, level: int, interner: StepInterner | None, cached: bool) -> str | tuple | Iterator:
+    # the JSON of a value if it can be made at once, a (step, level) pair to use the kept JSON of,
+    # or a generator of its parts for iterEncode to work through
+    if isinstance(value, _Cached) and (cached or interner is not None and interner.isShared(value)):
+        return value, level
+    if isinstance(value, Event_Step) and not value.hasSubsteps:
+        return _encodePlain(dict(value.jsonItems()), indentation, level)
+    if isinstance(value, _Cached):
+        return _encodeItems(value.jsonItems(), indentation, level, interner, cached)
+    if isinstance(value, dict):
+        return _encodeItems(value.items(), indentation, level, interner, cached)
+    if isinstance(value, list) and value and isinstance(value[0], Event_Step):
+        return _encodeSteps(value, indentation, level, interner, cached)
+    return _encodePlain(value, indentation, level)
+
+def _indented(text: str, indentation: int | None, level: int) -> str:
+    # json strings never contain line breaks, so JSON made at level 0 can be indented to any level afterwards
+    return text if indentation is None or not level else text.replace("\n", "\n" + " " * (indentation * level))
+
+_encoders: dict[int, json.JSONEncoder] = {}
+
+def _encodePlain(value: object, indentation: int | None, level: int) -> str:
+    if indentation is None: return json.dumps(value)
+    if indentation not in _encoders: _encoders[indentation] = json.JSONEncoder(indent = indentation)
+    return _indented(_encoders[indentation].encode(value), indentation, level)
+
+def _encodeSteps(steps: list[Event_Step], indentation: int | None, level: int, interner: StepInterner | None, cached: bool) -> Iterator:
+    if indentation is None:
+        separator, end = ", ", "]"
+    else:
+        separator = ",\n" + " " * (indentation * (level + 1))
+        end = "\n" + " " * (indentation * level) + "]"
+    yield "[" if indentation is None else "[\n" + " " * (indentation * (level + 1))
+    for i, step in enumerate(steps):
+        if i: yield separator
+        yield _encoded(step, indentation, level + 1, interner, cached)
+    yield end
+
+def _encodeItems(items: Iterator[tuple[object, object]], indentation: int | None, level: int, interner: StepInterner | None,
+        cached: bool) -> Iterator:
+    if indentation is None:
+        start, separator, end = "{", ", ", "}"
+    else:
+        start = separator = ",\n" + " " * (indentation * (level + 1))
+        start = "{" + start[1:]
+        end = "\n" + " " * (indentation * level) + "}"
+    empty = True
+    for key, value in items:
+        yield start if empty else separator
+        empty = False
+        yield json.dumps(key if isinstance(key, str) else json.dumps(key)) + ": "
+        yield _encoded(value, indentation, level + 1, interner, cached)
+    yield "{}" if empty else end
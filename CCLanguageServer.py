@@ -0,0 +1,336 @@
+import json
+import sys, time, bisect, traceback
+from urllib.parse import unquote, urlparse
+import CCEvents as Events
+import cc_eventscript_parser as Parser
+from cc_eventscript_parser import EventItem, EventItemType
+
+# ~ a language server for cc-eventscript ~
+# keeps the "== title ==" blocks of every open document in memory, and when a document changes, parses
+# only the blocks that the change touched. publishes the same errors and warnings as --diagnostics,
+# and answers "cces/previewEvent" requests with the compiled JSON of the event under the cursor.
+# speaks the language server protocol over stdio:
+#   python CCLanguageServer.py [-v]
+
+# json-rpc error codes
+methodNotFound = -32601
+internalError = -32603
+severities = {"error": 1, "warning": 2}
+
+
+def utf16Length(text: str) -> int:
+    # positions are counted in utf-16 code units by the protocol
+    return len(text) if text.isascii() else len(text.encode("utf-16-le")) // 2
+
+def utf16Index(text: str, character: int) -> int:
+    # the index into the string of a position counted in utf-16 code units
+    if text.isascii(): return min(character, len(text))
+    units: int = 0
+    for index, char in enumerate(text):
+        if units >= character: return index
+        units += 2 if ord(char) > 0xFFFF else 1
+    return len(text)
+
+def isTitle(line: str) -> bool:
+    # a title always starts a new event, whatever part of a file it's in
+    if "==" not in line: return False
+    return Parser.CCEventRegex.title.match(Parser.CCEventRegex.comment.sub("", line).strip()) is not None
+
+def uriToPath(uri: str) -> str:
+    parsedUri = urlparse(uri)
+    return unquote(parsedUri.path) if parsedUri.scheme == "file" else uri
+
+
+class EventBlock:
+    # the lines from one title up to the next, or those before the first title.
+    # everything found in it is relative to its first line, so it stays valid when the block moves.
+    __slots__ = ("start", "text", "items", "entries", "itemLines", "duplicate")
+
+    def __init__(self, start: int, text: str) -> None:
+        self.start: int = start
+        self.text: str = text
+        self.items: list[tuple[str, EventItem]] = []
+        self.entries: list[dict] = []
+        # the line of every import and include, to report them as duplicates at
+        self.itemLines: dict[str, int] = {}
+        # set when an earlier block has the same title, in which case the event isn't built, as in a normal build
+        self.duplicate: bool = False
+
+    def parse(self, filename: str, optimizer: "CCOptimizer.StepOptimizer | None" = None) -> None:
+        # collects the errors of the block the same way --diagnostics does for a whole file
+        diagnostics = Parser.Diagnostics()
+        self.items, error = Parser.parseSource(self.text, filename, diagnostics = diagnostics, optimizer = optimizer)
+        if error is not None:
+            diagnostics.eventTitle, diagnostics.message = None, None
+            diagnostics.reportError(error)
+        self.entries = diagnostics.entries
+        self.itemLines = {}
+        if any(item.eventType is not EventItemType.STANDARD_EVENT for _, item in self.items):
+            for token in Parser.tokenize(self.text):
+                if token.tokenType in (Parser.TokenType.IMPORT, Parser.TokenType.INCLUDE):
+                    self.itemLines.setdefault(token.values[1], token.lineNumber)
+
+    def itemLine(self, title: str, item: EventItem) -> int:
+        if item.eventType is EventItemType.STANDARD_EVENT: return self.start
+        return self.start + self.itemLines.get(title, 1) - 1
+
+    def event(self) -> tuple[str, EventItem] | None:
+        # the event the block builds, if any
+        if self.duplicate or not self.items: return None
+        title, item = self.items[0]
+        if item.eventType is not EventItemType.STANDARD_EVENT or item.event is None: return None
+        return title, item
+
+
+class Document:
+    def __init__(self, uri: str, text: str, optimizer: "CCOptimizer.StepOptimizer | None" = None) -> None:
+        self.uri: str = uri
+        self.filename: str = uriToPath(uri)
+        # the optimizer every block is parsed with, if the client asked for one
+        self.optimizer = optimizer
+        self.lines: list[str] = []
+        self.blocks: list[EventBlock] = []
+        # the number of blocks parsed by the last change
+        self.parsedBlocks: int = 0
+        self.setText(text)
+
+    def setText(self, text: str) -> None:
+        self.lines = text.split("\n")
+        self.blocks = self.splitBlocks(0, len(self.lines), self.blocks)
+
+    def splitBlocks(self, start: int, end: int, previousBlocks: list[EventBlock]) -> list[EventBlock]:
+        # splits lines start to end into blocks, which start at a title (or the first line).
+        # blocks with the same text as one of the previous blocks aren't parsed again.
+        previous = {block.text: block for block in previousBlocks}
+        self.parsedBlocks = 0
+        starts = [start] + [lineNumber for lineNumber in range(start + 1, end) if isTitle(self.lines[lineNumber])]
+        blocks: list[EventBlock] = []
+        for blockStart, blockEnd in zip(starts, starts[1:] + [end]):
+            text = "\n".join(self.lines[blockStart:blockEnd])
+            block = previous.pop(text, None)
+            if block is None:
+                block = EventBlock(blockStart, text)
+                block.parse(self.filename, self.optimizer)
+                self.parsedBlocks += 1
+            block.start = blockStart
+            blocks.append(block)
+        return blocks
+
+    def blockIndex(self, line: int) -> int:
+        return max(bisect.bisect_right(self.blocks, line, key = lambda block: block.start) - 1, 0)
+
+    def position(self, position: dict) -> tuple[int, int]:
+        # the line and index into it of a position. positions past the last line are at the end of the document.
+        if position["line"] >= len(self.lines): return len(self.lines) - 1, len(self.lines[-1])
+        line = self.lines[position["line"]]
+        return position["line"], utf16Index(line, position["character"])
+
+    def applyChange(self, change: dict) -> None:
+        if "range" not in change:
+            self.setText(change["text"])
+            return
+        startLine, startIndex = self.position(change["range"]["start"])
+        endLine, endIndex = self.position(change["range"]["end"])
+        prefix = self.lines[startLine][:startIndex]
+        suffix = self.lines[endLine][endIndex:]
+        newLines = (prefix + change["text"] + suffix).split("\n")
+
+        # the blocks the change touched are split again, along with the one before them, since the change may
+        # have removed the title of the first one, joining its lines to the block before
+        first = max(self.blockIndex(startLine) - 1, 0)
+        last = self.blockIndex(endLine)
+        delta = len(newLines) - (endLine - startLine + 1)
+        regionEnd = self.blocks[last + 1].start if last + 1 < len(self.blocks) else len(self.lines)
+        self.lines[startLine:endLine + 1] = newLines
+        for block in self.blocks[last + 1:]: block.start += delta
+        self.blocks[first:last + 1] = self.splitBlocks(self.blocks[first].start, regionEnd + delta, self.blocks[first:last + 1])
+
+    def lineRange(self, line: int) -> dict:
+        # the range of a line without its indentation
+        text = self.lines[line] if line < len(self.lines) else ""
+        stripped = text.strip()
+        start = utf16Length(text[:len(text) - len(text.lstrip())])
+        return {"start": {"line": line, "character": start}, "end": {"line": line, "character": start + utf16Length(stripped)}}
+
+    def diagnostics(self) -> list[dict]:
+        # duplicate titles are found across all the blocks, in order, as they would be in a normal build
+        items: dict[str, EventItem] = {}
+        results: list[tuple[int, dict]] = []
+        fileDiagnostics = Parser.Diagnostics()
+        fileDiagnostics.filename = self.filename
+        for block in self.blocks:
+            block.duplicate = False
+            for title, item in block.items:
+                try:
+                    Parser.addEventItem(items, title, item)
+                except KeyError as e:
+                    fileDiagnostics.eventTitle = title
+                    fileDiagnostics.reportError(e, block.itemLine(title, item))
+                    if item.eventType is EventItemType.STANDARD_EVENT: block.duplicate = True
+            if block.duplicate: continue
+            for entry in block.entries:
+                line = block.start if entry["line"] is None else block.start + entry["line"] - 1
+                results.append((line, entry))
+        results += [(entry["line"], entry) for entry in fileDiagnostics.entries]
+        results.sort(key = lambda result: result[0])
+        return [self.formatDiagnostic(line, entry) for line, entry in results]
+
+    def formatDiagnostic(self, line: int, entry: dict) -> dict:
+        context = []
+        if entry["event"] is not None: context.append(f"event '{entry['event']}'")
+        if entry["messageNumber"] is not None: context.append(f"message {entry['messageNumber']}")
+        return {
+            "range": self.lineRange(line),
+            "severity": severities[entry["severity"]],
+            "source": "cces",
+            "message": entry["message"] + (f" ({', '.join(context)})" if context else "")
+        }
+
+    def preview(self, line: int, indentation = None) -> dict | None:
+        block = self.blocks[self.blockIndex(line)]
+        event = block.event()
+        if event is None: return None
+        title, item = event
+        return {
+            "title": title,
+            "path": item.filepath,
+            # blocks that haven't changed keep their events, so previewing one again reuses its kept JSON
+            "json": "".join(Events.iterEncode({title: item.event}, indentation, cached = True))
+        }
+
+
+class LanguageServer:
+    def __init__(self, inputStream, outputStream, verbose: bool = False) -> None:
+        self.inputStream = inputStream
+        self.outputStream = outputStream
+        self.verbose: bool = verbose
+        self.documents: dict[str, Document] = {}
+        # the indentation of previewed JSON, which may be changed by the client's initialization options
+        self.indentation = 4
+        # set by the client's initialization options, and given to every document opened after
+        self.optimizer = None
+        self.shutDown: bool = False
+        self.exitCode: int | None = None
+
+    def readMessage(self) -> dict | None:
+        # returns None once the input is closed
+        contentLength: int | None = None
+        while True:
+            header = self.inputStream.readline()
+            if not header: return None
+            header = header.decode("ascii").strip()
+            if not header: break
+            name, _, value = header.partition(":")
+            if name.strip().lower() == "content-length": contentLength = int(value)
+        if contentLength is None: return None
+        return json.loads(self.inputStream.read(contentLength).decode("utf8"))
+
+    def sendMessage(self, message: dict) -> None:
+        body = json.dumps({"jsonrpc": "2.0", **message}, separators = (",", ":")).encode("utf8")
+        self.outputStream.write(f"Content-Length: {len(body)}\r\n\r\n".encode("ascii") + body)
+        self.outputStream.flush()
+
+    def publishDiagnostics(self, document: Document, diagnostics: list[dict] | None = None) -> None:
+        if diagnostics is None: diagnostics = document.diagnostics()
+        self.sendMessage({"method": "textDocument/publishDiagnostics", "params": {"uri": document.uri, "diagnostics": diagnostics}})
+
+    def handle(self, message: dict) -> None:
+        method = message.get("method")
+        params = message.get("params") or {}
+        isRequest = "id" in message
+        if method is None: return
+        start = time.perf_counter()
+        try:
+            handler = getattr(self, "on_" + method.replace("/", "_").replace("$", "_"), None)
+            if handler is None:
+                if isRequest: self.sendMessage({"id": message["id"], "error": {"code": methodNotFound, "message": f"unknown method '{method}'"}})
+                return
+            result = handler(params)
+            if isRequest: self.sendMessage({"id": message["id"], "result": result})
+        except Exception as e:
+            # errors the client caused are only reported back to it
+            if not isinstance(e, Parser.CCES_Exception): traceback.print_exc()
+            if isRequest: self.sendMessage({"id": message["id"], "error": {"code": internalError, "message": str(e) or type(e).__name__}})
+        if self.verbose: print(f"{method}: {(time.perf_counter() - start) * 1000:.2f} ms", file = sys.stderr)
+
+    def serve(self) -> int:
+        # returns the exit code: 0 if the client shut the server down before exiting, as it should, and 1 otherwise
+        while self.exitCode is None:
+            message = self.readMessage()
+            if message is None: return 1
+            self.handle(message)
+        return self.exitCode
+
+    def document(self, uri: str) -> Document:
+        if uri not in self.documents: raise Parser.CCES_Exception(f"Error: document '{uri}' isn't open")
+        return self.documents[uri]
+
+    def on_initialize(self, params: dict) -> dict:
+        options = params.get("initializationOptions") or {}
+        self.indentation = options.get("indentation", self.indentation)
+        if options.get("optimize"):
+            import CCOptimizer
+            self.optimizer = CCOptimizer.StepOptimizer()
+        return {
+            "capabilities": {
+                # changes are sent as ranges, rather than whole documents
+                "textDocumentSync": {"openClose": True, "change": 2},
+                "executeCommandProvider": {"commands": ["cces.previewEvent"]}
+            },
+            "serverInfo": {"name": "cc-eventscript", "version": Parser.parserVersion}
+        }
+
+    def on_initialized(self, params: dict) -> None: pass
+
+    def on_shutdown(self, params: dict) -> None:
+        self.shutDown = True
+
+    def on_exit(self, params: dict) -> None:
+        self.exitCode = 0 if self.shutDown else 1
+
+    def on_textDocument_didOpen(self, params: dict) -> None:
+        textDocument = params["textDocument"]
+        document = self.documents[textDocument["uri"]] = Document(textDocument["uri"], textDocument["text"], self.optimizer)
+        self.publishDiagnostics(document)
+
+    def on_textDocument_didChange(self, params: dict) -> None:
+        document = self.document(params["textDocument"]["uri"])
+        parsedBlocks: int = 0
+        for change in params["contentChanges"]:
+            document.applyChange(change)
+            parsedBlocks += document.parsedBlocks
+        if self.verbose: print(f"Parsed {parsedBlocks} of {len(document.blocks)} blocks.", file = sys.stderr)
+        self.publishDiagnostics(document)
+
+    def on_textDocument_didClose(self, params: dict) -> None:
+        document = self.document(params["textDocument"]["uri"])
+        del self.documents[document.uri]
+        self.publishDiagnostics(document, [])
+
+    def on_cces_previewEvent(self, params: dict) -> dict | None:
+        # params are a text document and a position, as for any request about the cursor
+        document = self.document(params["textDocument"]["uri"])
+        return document.preview(params["position"]["line"], self.indentation)
+
+    def on_workspace_executeCommand(self, params: dict) -> dict | None:
+        # the same preview, for clients that can only send commands. its arguments are the uri and line.
+        if params["command"] != "cces.previewEvent": raise Parser.CCES_Exception(f"Error: unknown command '{params['command']}'")
+        uri, line = params["arguments"]
+        return self.document(uri).preview(line, self.indentation)
+
+    def on___cancelRequest(self, params: dict) -> None:
+        # every request is answered straight away, so there's never anything to cancel
+        pass
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description = "Run a cc-eventscript language server over stdio.")
+    parser.add_argument("-v", "--verbose", action = "store_true", help = "log the time taken by every message to stderr")
+    args = parser.parse_args()
+
+    # anything the parser prints would corrupt the messages, so it's sent to stderr instead
+    outputStream = sys.stdout.buffer
+    sys.stdout = sys.stderr
+    server = LanguageServer(sys.stdin.buffer, outputStream, args.verbose)
+    sys.exit(server.serve())
@@ -0,0 +1,153 @@
+import sys
+import CCEvents as Events
+from CCEvents import ChangeVarType
+
+# ~ an optimization pass over compiled cc-eventscript steps ~
+# folds "if true" and "if false", drops branches and steps that can never run, and merges changes to
+# the same variable that directly follow each other.
+# labels are never moved or removed, since it isn't known which gotos can reach them.
+
+
+def countSteps(steps: list[Events.Event_Step]) -> int:
+    return sum(1 + countSteps(list(step.heldSteps())) for step in steps)
+
+def containsLabel(steps: list[Events.Event_Step]) -> bool:
+    return any(isinstance(step, Events.LABEL) or containsLabel(list(step.heldSteps())) for step in steps)
+
+def isUnconditionalGoto(step: Events.Event_Step) -> bool:
+    return isinstance(step, Events.GOTO_LABEL) and not isinstance(step, Events.GOTO_LABEL_WHILE)
+
+def encodedSize(steps: list[Events.Event_Step]) -> int:
+    return sum(len(chunk) for chunk in Events.iterEncode(steps))
+
+
+def mergeNumberChanges(first: Events.CHANGE_VAR_NUMBER, second: Events.CHANGE_VAR_NUMBER) -> Events.CHANGE_VAR_NUMBER | None:
+    # returns a single step with the same effect as both, if there is one.
+    # division and modulo are left alone, as they don't combine exactly.
+    signs = {ChangeVarType.ADD: 1, ChangeVarType.SUB: -1}
+    if second.changeType is ChangeVarType.SET: return second
+    if first.changeType is ChangeVarType.SET:
+        if second.changeType in signs: return Events.CHANGE_VAR_NUMBER(first.varName, first.value + signs[second.changeType] * second.value, ChangeVarType.SET)
+        if second.changeType is ChangeVarType.MUL: return Events.CHANGE_VAR_NUMBER(first.varName, first.value * second.value, ChangeVarType.SET)
+    elif first.changeType in signs and second.changeType in signs:
+        total = signs[first.changeType] * first.value + signs[second.changeType] * second.value
+        return Events.CHANGE_VAR_NUMBER(first.varName, abs(total), ChangeVarType.ADD if total >= 0 else ChangeVarType.SUB)
+    elif first.changeType is ChangeVarType.MUL and second.changeType is ChangeVarType.MUL:
+        return Events.CHANGE_VAR_NUMBER(first.varName, first.value * second.value, ChangeVarType.MUL)
+    return None
+
+def mergeBoolChanges(first: Events.CHANGE_VAR_BOOL, second: Events.CHANGE_VAR_BOOL) -> Events.CHANGE_VAR_BOOL | None:
+    if second.changeType is ChangeVarType.SET: return second
+    if first.changeType is ChangeVarType.SET:
+        value = first.value or second.value if second.changeType is ChangeVarType.OR else first.value != second.value
+        return Events.CHANGE_VAR_BOOL(first.varName, value, ChangeVarType.SET)
+    if first.changeType is second.changeType is ChangeVarType.OR:
+        return Events.CHANGE_VAR_BOOL(first.varName, first.value or second.value, ChangeVarType.OR)
+    if first.changeType is second.changeType is ChangeVarType.XOR:
+        return Events.CHANGE_VAR_BOOL(first.varName, first.value != second.value, ChangeVarType.XOR)
+    return None
+
+
+class StepOptimizer:
+    # optimizes the steps of each message in place, and counts what it removed for the report.
+    # the size of the output is only measured with measureSize, as that means encoding every message again.
+    statNames = ("messages", "stepsBefore", "stepsAfter", "bytesBefore", "bytesAfter",
+        "foldedConditions", "removedBranches", "unreachableSteps", "mergedChanges", "invertedConditions")
+    # the stats that count changes to the steps. a message none of them counted is left as it was.
+    changeNames = ("foldedConditions", "removedBranches", "unreachableSteps", "mergedChanges", "invertedConditions")
+
+    def __init__(self, measureSize: bool = False) -> None:
+        self.measureSize: bool = measureSize
+        self.stats: dict[str, int] = {name: 0 for name in StepOptimizer.statNames}
+
+    def addStats(self, stats: dict[str, int]) -> None:
+        for name, value in stats.items(): self.stats[name] += value
+
+    def optimizeSteps(self, steps: list[Events.Event_Step]) -> list[Events.Event_Step]:
+        self.stats["messages"] += 1
+        self.stats["stepsBefore"] += countSteps(steps)
+        if self.measureSize:
+            size = encodedSize(steps)
+            self.stats["bytesBefore"] += size
+            changes = self.countChanges()
+        steps = self.optimizeList(steps)
+        self.stats["stepsAfter"] += countSteps(steps)
+        # a message that wasn't changed doesn't have to be encoded again
+        if self.measureSize: self.stats["bytesAfter"] += size if self.countChanges() == changes else encodedSize(steps)
+        return steps
+
+    def countChanges(self) -> int:
+        return sum(self.stats[name] for name in StepOptimizer.changeNames)
+
+    def optimizeList(self, steps: list[Events.Event_Step]) -> list[Events.Event_Step]:
+        result: list[Events.Event_Step] = []
+        # steps after a goto can't run, unless there's a label among them to jump back in at
+        unreachable: bool = False
+        for step in steps:
+            if unreachable:
+                if not containsLabel([step]):
+                    self.stats["unreachableSteps"] += countSteps([step])
+                    continue
+                unreachable = False
+            replacement = self.optimizeIf(step) if isinstance(step, Events.IF) else [step]
+            for newStep in replacement:
+                self.append(result, newStep)
+            if replacement and isUnconditionalGoto(replacement[-1]): unreachable = True
+        return result
+
+    def optimizeIf(self, step: Events.IF) -> list[Events.Event_Step]:
+        # returns the steps the "if" is replaced by
+        step.thenStep = self.optimizeList(step.thenStep)
+        step.elseStep = self.optimizeList(step.elseStep)
+        condition = step.condition.strip()
+        if condition in ("true", "false"):
+            branch, deadBranch = (step.thenStep, step.elseStep) if condition == "true" else (step.elseStep, step.thenStep)
+            if not containsLabel(deadBranch):
+                # the steps can only replace the "if" if no goto or label changes the block it's in
+                if not any(isinstance(branchStep, (Events.LABEL, Events.GOTO_LABEL)) for branchStep in branch):
+                    self.stats["foldedConditions"] += 1
+                    self.stats["removedBranches"] += 1 if deadBranch else 0
+                    self.stats["unreachableSteps"] += countSteps(deadBranch)
+                    return branch
+                if deadBranch:
+                    self.stats["removedBranches"] += 1
+                    self.stats["unreachableSteps"] += countSteps(deadBranch)
+                    if condition == "true": step.elseStep = []
+                    else: step.thenStep = []
+
+        if not step.thenStep:
+            # nothing happens either way, and conditions have no side effects
+            if not step.elseStep:
+                self.stats["removedBranches"] += 1
+                return []
+            # an empty "then" is kept in the output, but an empty "else" isn't
+            step.condition = "true" if condition == "false" else f"!({step.condition})"
+            step.thenStep, step.elseStep = step.elseStep, []
+            self.stats["invertedConditions"] += 1
+        return [step]
+
+    def append(self, result: list[Events.Event_Step], step: Events.Event_Step) -> None:
+        previous = result[-1] if result else None
+        merged = None
+        if isinstance(previous, Events.CHANGE_VAR_NUMBER) and isinstance(step, Events.CHANGE_VAR_NUMBER) and previous.varName == step.varName:
+            merged = mergeNumberChanges(previous, step)
+        elif isinstance(previous, Events.CHANGE_VAR_BOOL) and isinstance(step, Events.CHANGE_VAR_BOOL) and previous.varName == step.varName:
+            merged = mergeBoolChanges(previous, step)
+        if merged is None:
+            result.append(step)
+            return
+        self.stats["mergedChanges"] += 1
+        # changes that add up to nothing are dropped altogether
+        if isinstance(merged, Events.CHANGE_VAR_NUMBER) and merged.changeType is ChangeVarType.ADD and merged.value == 0: result.pop()
+        else: result[-1] = merged
+
+    def printSummary(self, file = sys.stdout) -> None:
+        stats = self.stats
+        removedSteps = stats["stepsBefore"] - stats["stepsAfter"]
+        removedBytes = stats["bytesBefore"] - stats["bytesAfter"]
+        sizeReport = f" and {removedBytes} of {stats['bytesBefore']} bytes ({removedBytes / max(stats['bytesBefore'], 1):.1%})" if self.measureSize else ""
+        print(f"Optimized {stats['messages']} messages: removed {removedSteps} of {stats['stepsBefore']} steps "
+            f"({removedSteps / max(stats['stepsBefore'], 1):.1%}){sizeReport}.", file = file)
+        print(f"  folded {stats['foldedConditions']} conditions, removed {stats['removedBranches']} branches and "
+            f"{stats['unreachableSteps']} unreachable steps, merged {stats['mergedChanges']} variable changes, "
+            f"inverted {stats['invertedConditions']} conditions with an empty branch", file = file)
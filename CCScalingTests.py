@@ -0,0 +1,137 @@
+import hashlib, math, os, sys, subprocess, tempfile
+import CCEvents as Events
+import cc_eventscript_parser as Parser
+from CCBenchmark import CorpusParameters, generateCorpus, timePhase
+
+# ~ scaling tests for the cc-eventscript parser ~
+# builds generated corpora of growing size along one axis at a time, and fails if the time taken
+# grows clearly faster than the size. also checks that the output hasn't changed at all.
+# to run:
+#   python CCScalingTests.py
+
+# growth is fitted as time ~ size ^ exponent. anything linear should stay well below this.
+maxExponent = 1.4
+repeat = 3
+
+# the axis being grown, its sizes, and the parameters everything else is kept at
+axes = [
+    ("events", [50, 100, 200, 400], dict(messages = 2, lines = 6, depth = 1, files = 5)),
+    ("messages", [2, 4, 8, 16], dict(events = 30, lines = 6, depth = 1, files = 5)),
+    ("depth", [2, 4, 8, 16], dict(events = 30, messages = 2, lines = 4, files = 5)),
+    ("files", [5, 10, 20, 40], dict(events = 200, messages = 2, lines = 6, depth = 1)),
+]
+
+# sha256 of every output file, for each input and indentation. made with the original parser.
+goldenParameters = CorpusParameters(events = 60, messages = 3, lines = 6, depth = 3, files = 3, seed = 7)
+goldenDigests = {
+    ("example", None): "9118e39c40aa89b919ce24fc7c6adc903e9b22082a107b731dc89ebd5ed9e2d3",
+    ("example", 4): "ae9c7c0251133e9b527c2f5c05cb20590d0cd7363fa6ac52abcb6fef524e06b5",
+    ("generated", None): "3dc8a7184f99d4132d71da7b7add9c9b44b3c62c5c17ffd204050a57691b4581",
+    ("generated", 4): "aa704cc06286326a79a6e25a0ce023b934f446e371ee46a28a66735fbca3e0ef",
+}
+
+
+def fitExponent(sizes: list[int], times: list[float]) -> float:
+    # the slope of the least squares line through log(time) against log(size)
+    xs = [math.log(size) for size in sizes]
+    ys = [math.log(max(duration, 1e-9)) for duration in times]
+    meanX = sum(xs) / len(xs)
+    meanY = sum(ys) / len(ys)
+    return sum((x - meanX) * (y - meanY) for x, y in zip(xs, ys)) / sum((x - meanX) ** 2 for x in xs)
+
+def serialize(events: dict[str, Parser.EventItem]) -> int:
+    size: int = 0
+    for eventName, eventInfo in events.items():
+        if eventInfo.event is not None: size += len("".join(Events.iterEncode({eventName: eventInfo.event})))
+    return size
+
+def testScaling(axis: str, sizes: list[int], fixed: dict, workDirectory: str) -> bool:
+    parseTimes: list[float] = []
+    serializeTimes: list[float] = []
+    for size in sizes:
+        filenames = generateCorpus(os.path.join(workDirectory, f"{axis}-{size}"), CorpusParameters(**fixed, **{axis: size}))
+        parseTime, events = timePhase(lambda: Parser.parseFiles(filenames), repeat)
+        serializeTime, _ = timePhase(lambda: serialize(events), repeat)
+        parseTimes.append(parseTime)
+        serializeTimes.append(serializeTime)
+        print(f"  {axis} = {size:4}: parseFiles {parseTime * 1000:8.2f} ms, serializing {serializeTime * 1000:8.2f} ms")
+
+    passed = True
+    for phase, times in (("parseFiles", parseTimes), ("serializing", serializeTimes)):
+        exponent = fitExponent(sizes, times)
+        if exponent > maxExponent:
+            print(f"Test failed! {phase} grows as {axis} ^ {exponent:.2f}")
+            passed = False
+        else:
+            print(f"Test passed! {phase} grows as {axis} ^ {exponent:.2f}")
+    return passed
+
+
+def digestDirectory(directory: str) -> str:
+    # covers the relative path and text of every file, so it's the same on every platform
+    digest = hashlib.sha256()
+    for root, directories, filenames in sorted(os.walk(directory)):
+        directories.sort()
+        for filename in sorted(filenames):
+            path = os.path.join(root, filename)
+            digest.update(os.path.relpath(path, directory).replace(os.sep, "/").encode("utf8") + b"\0")
+            with open(path, "r", encoding = "utf8") as outputFile:
+                digest.update(outputFile.read().encode("utf8") + b"\0")
+    return digest.hexdigest()
+
+def buildInto(directory: str, filenames: list[str], indentation: int | None, jobs: int = 1) -> None:
+    workingDirectory = os.getcwd()
+    os.chdir(directory)
+    try:
+        events = Parser.parseFiles(filenames, jobs = jobs)
+        Parser.writeEventFiles(events, indentation)
+        Parser.writeDatabasePatchfile(Parser.generatePatchFile(events), "./assets/data/database.json.patch", indentation)
+    finally:
+        os.chdir(workingDirectory)
+
+def buildSharded(directory: str, filenames: list[str], indentation: int | None, shards: int = 3) -> None:
+    # every shard runs as its own process at the same time, as it would on separate machines
+    root = os.path.dirname(os.path.abspath(__file__))
+    indentArgs = ["-i", str(indentation)] if indentation is not None else []
+    with tempfile.TemporaryDirectory() as manifestDirectory:
+        manifests = [os.path.join(manifestDirectory, f"shard-{index}.json") for index in range(1, shards + 1)]
+        processes = [subprocess.Popen([sys.executable, os.path.join(root, "cc_eventscript_parser.py"), *indentArgs, "--shard", f"{index}/{shards}",
+            "--manifest", manifest, *filenames], cwd = directory, stdout = subprocess.DEVNULL) for index, manifest in enumerate(manifests, 1)]
+        if any(process.wait() != 0 for process in processes): raise RuntimeError("a shard failed")
+        subprocess.run([sys.executable, os.path.join(root, "CCShards.py"), "merge", *indentArgs, *manifests], cwd = directory, stdout = subprocess.DEVNULL, check = True)
+
+def testGolden(workDirectory: str) -> bool:
+    inputs = {
+        "example": [os.path.abspath(os.path.join(os.path.dirname(__file__), "example.cces"))],
+        "generated": generateCorpus(os.path.join(workDirectory, "golden"), goldenParameters),
+    }
+    passed = True
+    # every way of building has to give the same output
+    for mode in ("", "shared steps", "sharded", "parallel jobs"):
+        Parser.interner = Events.StepInterner() if mode == "shared steps" else None
+        for (name, indentation), expected in goldenDigests.items():
+            with tempfile.TemporaryDirectory() as outputDirectory:
+                if mode == "sharded": buildSharded(outputDirectory, inputs[name], indentation)
+                else: buildInto(outputDirectory, inputs[name], indentation, 3 if mode == "parallel jobs" else 1)
+                digest = digestDirectory(outputDirectory)
+            label = f"{name}, indentation {indentation}" + (f", {mode}" if mode else "")
+            if digest == expected:
+                print(f"Test passed! ({label})")
+            else:
+                print(f"Test failed! ({label})")
+                print(f"Expected: {expected}")
+                print(f"Received: {digest}")
+                passed = False
+    Parser.interner = None
+    return passed
+
+
+if __name__ == "__main__":
+    allPassed = True
+    with tempfile.TemporaryDirectory() as workDirectory:
+        print("Testing golden output")
+        allPassed &= testGolden(workDirectory)
+        for axis, sizes, fixed in axes:
+            print(f"Testing scaling with {axis}")
+            allPassed &= testScaling(axis, sizes, fixed, workDirectory)
+    sys.exit(0 if allPassed else 1)
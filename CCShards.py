@@ -0,0 +1,66 @@
+import json
+import argparse
+import cc_eventscript_parser as Parser
+from cc_eventscript_parser import EventItem, EventItemType
+
+# ~ merges sharded cc-eventscript builds ~
+# a build can be split between several runs of the parser with --shard, possibly on different machines.
+# each shard writes the event files for its own input files, and a manifest of every event it found.
+# the manifests are then merged into a single patch file, with the same errors a single build would give.
+# shards can't see each other's events, so two of them may write the same event file. the file is named
+# after the event's title, so the merge then fails on the duplicate title, just as a single build would.
+# to run:
+#   python cc_eventscript_parser.py [options] --shard i/N [--manifest MANIFEST] file [file ...]
+#   python CCShards.py merge [-i [NUM]] [-p DATABASE] manifest [manifest ...]
+
+
+def mergeManifests(manifests: list[dict]) -> dict[str, EventItem]:
+    # checks that the manifests make up one whole build, then merges their events in input file order.
+    # raises the same errors as parseFiles would for the whole build.
+    if not manifests: raise Parser.CCES_Exception("Error: no manifests to merge")
+    count = manifests[0]["shards"]
+    inputFiles = manifests[0]["inputFiles"]
+    inputHash = manifests[0]["inputHash"]
+    for manifest in manifests:
+        if manifest["parserVersion"] != Parser.parserVersion:
+            raise Parser.CCES_Exception(f"Error: shard {manifest['shard']} was built by parser version {manifest['parserVersion']}, not {Parser.parserVersion}")
+        if manifest.get("cacheVersion") != Parser.cacheVersion:
+            raise Parser.CCES_Exception(f"Error: shard {manifest['shard']} was built with cache version {manifest.get('cacheVersion')}, not {Parser.cacheVersion}")
+        if manifest["shards"] != count or manifest["inputFiles"] != inputFiles or manifest["inputHash"] != inputHash:
+            raise Parser.CCES_Exception(f"Error: shard {manifest['shard']} is from a different build")
+    shards = sorted(manifest["shard"] for manifest in manifests)
+    if shards != list(range(1, count + 1)):
+        missing = sorted(set(range(1, count + 1)) - set(shards))
+        if missing: raise Parser.CCES_Exception(f"Error: missing shards {', '.join(str(shard) for shard in missing)} of {count}")
+        raise Parser.CCES_Exception("Error: the same shard was given more than once")
+
+    files = sorted((entry for manifest in manifests for entry in manifest["files"]), key = lambda entry: entry["index"])
+    if [entry["index"] for entry in files] != list(range(inputFiles)):
+        raise Parser.CCES_Exception("Error: the shards don't cover every input file exactly once")
+
+    eventDict: dict[str, EventItem] = {}
+    for entry in files:
+        items = [(eventTitle, EventItem(EventItemType[eventType], eventPath)) for eventTitle, eventType, eventPath in entry["items"]]
+        Parser.mergeItems(eventDict, entry["file"], items, Parser.decodeError(entry["error"]))
+    return eventDict
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Combine the results of a sharded cc-eventscript build.")
+    subparsers = parser.add_subparsers(dest = "command", required = True)
+
+    mergeParser = subparsers.add_parser("merge", help = "merge the manifests written by every shard into one patch file")
+    mergeParser.add_argument("manifest", nargs = "+", help = "the manifest written by each shard, in any order")
+    mergeParser.add_argument("-i", "--indent", type = int, default = None, dest = "indentation", metavar = "NUM", nargs = "?", const = 4, help = "the indentation of the patch file, if any. if supplied without a number, will default to 4 spaces")
+    mergeParser.add_argument("-p", "--patch-file", default = "./assets/data/database.json.patch", dest = "databaseFile", metavar = "DATABASE", help = "the location of the database patch file")
+    mergeParser.add_argument("-v", "--verbose", action = "store_true", help = "increases verbosity of output")
+    args = parser.parse_args()
+
+    Parser.verbose = args.verbose
+    manifests: list[dict] = []
+    for filename in args.manifest:
+        with open(filename, "r", encoding = "utf8") as manifestFile:
+            manifests.append(json.load(manifestFile))
+    events = mergeManifests(manifests)
+    wasWritten = Parser.writeDatabasePatchfile(Parser.generatePatchFile(events), args.databaseFile, args.indentation)
+    print(f"Merged {len(manifests)} shards, {'wrote' if wasWritten else 'skipped unchanged'} patch file.")
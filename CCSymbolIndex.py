@@ -0,0 +1,179 @@
+import os, re, sys, sqlite3, argparse
+from enum import Enum
+from collections.abc import Iterable, Iterator
+import cc_eventscript_parser as Parser
+from cc_eventscript_parser import Token, TokenType
+
+# ~ a searchable index of the symbols used in cc-eventscript files ~
+# records where variables are set and read, where labels are defined and jumped to, and which characters speak,
+# along with the file, event title, message number and line of each.
+# messages are numbered in the order they appear in their event, starting from 1, whatever number their
+# header gives them. that's the number the build's diagnostics report and the output checks call.runCount against.
+# files are only indexed again once they change. a build with --index hands over the tokens it
+# already read, so only files it skipped are read again here.
+# to run:
+#   python CCSymbolIndex.py [--db INDEX] update [-r] file [file ...]
+#   python CCSymbolIndex.py [--db INDEX] query [-k KIND] [-e EVENT] name
+
+defaultIndexFile = "./.cces-index.sqlite"
+# changed whenever what's indexed changes, so older indexes are rebuilt. the parser's cache version is included too.
+indexVersion = 2
+
+class SymbolKind(Enum):
+    SET = "set"
+    READ = "read"
+    LABEL = "label"
+    GOTO = "goto"
+    CHARACTER = "character"
+
+# matches the variables in a condition, such as "tmp.foo" or "party.alive.Apollo"
+variable = re.compile(r"(?<![\w.])[A-Za-z_]\w*(?:\.[\w-]+)+")
+
+schema = """
+CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, mtime INTEGER, size INTEGER);
+CREATE TABLE IF NOT EXISTS symbols (kind TEXT, name TEXT, path TEXT, event TEXT, message INTEGER, line INTEGER);
+CREATE INDEX IF NOT EXISTS symbolNames ON symbols (name);
+CREATE INDEX IF NOT EXISTS symbolPaths ON symbols (path);
+"""
+
+
+def iterSymbols(tokens: Iterable[Token]) -> Iterator[tuple[SymbolKind, str, str, int | None, int]]:
+    # yields the kind, name, event title, message number and line of every symbol in a file's tokens.
+    # ignored events are skipped by the lexer, and properties have no message number.
+    eventTitle: str | None = None
+    message: int | None = None
+    # the number of messages so far in the event
+    messageCount: int = 0
+    for token in tokens:
+        match token.tokenType:
+            case TokenType.TITLE:
+                eventTitle = token.values[1].replace("/", ".")
+                message = None
+                messageCount = 0
+            case TokenType.EVENT_HEADER:
+                messageCount += 1
+                message = messageCount
+            # property names aren't case-sensitive, just as when events are built
+            case TokenType.PROPERTY if token.values[0].lower() == "condition":
+                for name in variable.findall(token.values[1]): yield SymbolKind.READ, name, eventTitle, message, token.lineNumber
+            case TokenType.IF:
+                for name in variable.findall(token.values[0]): yield SymbolKind.READ, name, eventTitle, message, token.lineNumber
+            case TokenType.SET_VAR_BOOL | TokenType.SET_VAR_NUM:
+                yield SymbolKind.SET, token.values[0], eventTitle, message, token.lineNumber
+            case TokenType.LABEL:
+                yield SymbolKind.LABEL, token.values[0], eventTitle, message, token.lineNumber
+            case TokenType.GOTO_LABEL:
+                yield SymbolKind.GOTO, token.values[0], eventTitle, message, token.lineNumber
+                if token.values[1]:
+                    for name in variable.findall(token.values[1]): yield SymbolKind.READ, name, eventTitle, message, token.lineNumber
+            case TokenType.DIALOGUE:
+                yield SymbolKind.CHARACTER, token.values[0].strip(), eventTitle, message, token.lineNumber
+
+
+class SymbolIndex:
+    # the whole index is cleared if the index or cache version changes.
+    def __init__(self, filename: str = defaultIndexFile) -> None:
+        self.filename: str = filename
+        self.connection = sqlite3.connect(filename)
+        self.connection.executescript(schema)
+        version = f"{Parser.cacheVersion}.{indexVersion}"
+        row = self.connection.execute("SELECT value FROM settings WHERE key = 'version'").fetchone()
+        if row is None or row[0] != version:
+            with self.connection:
+                self.connection.execute("DELETE FROM files")
+                self.connection.execute("DELETE FROM symbols")
+                self.connection.execute("INSERT OR REPLACE INTO settings VALUES ('version', ?)", (version,))
+        # path -> the symbols of a file a build has already tokenized, used by the next update
+        self.pendingSymbols: dict[str, list[tuple]] = {}
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def fileUpToDate(self, path: str, stats: list[int] | None) -> bool:
+        row = self.connection.execute("SELECT mtime, size FROM files WHERE path = ?", (path,)).fetchone()
+        return row is not None and list(row) == stats
+
+    def addTokens(self, filename: str, tokens: list[Token]) -> None:
+        # given the tokens of each file as a build reads it, so the file doesn't have to be read again.
+        self.pendingSymbols[os.path.abspath(filename)] = list(iterSymbols(tokens))
+
+    def updateFile(self, path: str, stats: list[int], symbols: Iterable[tuple] | None = None) -> None:
+        if symbols is None:
+            with open(path, "r", encoding = "utf8") as inputFile:
+                symbols = iterSymbols(Parser.tokenize(inputFile.read()))
+        self.connection.execute("DELETE FROM symbols WHERE path = ?", (path,))
+        self.connection.executemany("INSERT INTO symbols VALUES (?, ?, ?, ?, ?, ?)",
+            ((kind.value, name, path, eventTitle, message, line) for kind, name, eventTitle, message, line in symbols))
+        self.connection.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?)", (path, *stats))
+
+    def update(self, filelist: list[str]) -> tuple[int, int]:
+        # indexes the files that changed since they were last indexed, and forgets those that no longer exist.
+        # returns the number of files indexed and the number skipped as unchanged.
+        updated: int = 0
+        skipped: int = 0
+        pendingSymbols, self.pendingSymbols = self.pendingSymbols, {}
+        with self.connection:
+            for filename in filelist:
+                path = os.path.abspath(filename)
+                stats = Parser.BuildCache.fileStats(path)
+                if stats is None: continue
+                if self.fileUpToDate(path, stats):
+                    skipped += 1
+                    continue
+                self.updateFile(path, stats, pendingSymbols.get(path))
+                updated += 1
+            for (path,) in self.connection.execute("SELECT path FROM files").fetchall():
+                if os.path.isfile(path): continue
+                self.connection.execute("DELETE FROM symbols WHERE path = ?", (path,))
+                self.connection.execute("DELETE FROM files WHERE path = ?", (path,))
+        return updated, skipped
+
+    def query(self, name: str, kind: SymbolKind | None = None, event: str | None = None) -> list[tuple]:
+        # names and event titles are matched as case-sensitive globs.
+        sql = "SELECT kind, name, path, event, message, line FROM symbols WHERE name GLOB ?"
+        parameters: list = [name]
+        if kind is not None:
+            sql += " AND kind = ?"
+            parameters.append(kind.value)
+        if event is not None:
+            sql += " AND event GLOB ?"
+            parameters.append(event)
+        return self.connection.execute(sql + " ORDER BY path, line", parameters).fetchall()
+
+
+def formatSymbol(symbol: tuple) -> str:
+    kind, name, path, eventTitle, message, line = symbol
+    location = eventTitle if message is None else f"{eventTitle}, message {message}"
+    return f"{os.path.relpath(path)}:{line}: {kind} {name} ({location})"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Index the symbols used in cc-eventscript files, and look them up.")
+    parser.add_argument("--db", default = defaultIndexFile, dest = "indexFile", metavar = "INDEX", help = f"the location of the index. defaults to '{defaultIndexFile}'")
+    subparsers = parser.add_subparsers(dest = "command", required = True)
+
+    updateParser = subparsers.add_parser("update", help = "index any input files that changed since they were last indexed")
+    updateParser.add_argument("file", nargs = "+", help = "the eventscript file(s) to index. A file path if -r is enabled.")
+    updateParser.add_argument("-r", action = "store_true", dest = "recursive", help = "index all files ending in '.cces' in the given directories and their subdirectories")
+
+    queryParser = subparsers.add_parser("query", help = "find where a symbol is used",
+        description = "Find where a symbol is used. Each result gives its file and line, and its event and message. Messages are numbered "
+        "in the order they appear in their event, starting from 1, as in the build's diagnostics, rather than by the number in their header.")
+    queryParser.add_argument("name", help = "the name of the variable, label or character. may be a glob pattern")
+    queryParser.add_argument("-k", "--kind", choices = [kind.value for kind in SymbolKind], default = None, help = "only find symbols of this kind")
+    queryParser.add_argument("-e", "--event", default = None, metavar = "GLOB", help = "only find symbols in events whose title matches this pattern")
+    args = parser.parse_args()
+
+    if args.command == "update":
+        index = SymbolIndex(args.indexFile)
+        updated, skipped = index.update(Parser.findInputFiles(args.file, args.recursive))
+        print(f"Indexed {updated} files, skipped {skipped} unchanged files.")
+    else:
+        if not os.path.isfile(args.indexFile):
+            print(f"No index found at '{args.indexFile}'.", file = sys.stderr)
+            sys.exit(1)
+        index = SymbolIndex(args.indexFile)
+        kind = SymbolKind(args.kind) if args.kind else None
+        for symbol in index.query(args.name, kind, args.event): print(formatSymbol(symbol))
+    index.close()
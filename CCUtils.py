@@ -1,4 +1,21 @@
+import weakref
+
 class Character:
+    __slots__ = ("name", "expression", "internalName", "__weakref__")
+    # characters are shared between every message that uses the same name and expression,
+    # so they must not be modified after creation. the table only holds them while some
+    # event still does, so long-running --watch and language server sessions don't keep
+    # every character they have ever seen.
+    _interned: "weakref.WeakValueDictionary[tuple[str, str], Character]" = weakref.WeakValueDictionary()
+
+    @staticmethod
+    def intern(name: str, expression: str) -> "Character":
+        key = (name, expression)
+        character = Character._interned.get(key)
+        if character is None:
+            character = Character._interned[key] = Character(name, expression)
+        return character
+
     @staticmethod
     def characterLookup(charName: str) -> str:
         match charName.lower():
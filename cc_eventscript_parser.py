@@ -1,5 +1,7 @@
 import json
-import os, re, sys, argparse
+import os, re, sys, builtins, time
+import contextlib, io, itertools
+from collections.abc import Callable, Iterable, Iterator
 import CCEvents as Events
 import CCUtils
 from CCEvents import ChangeVarType
@@ -8,46 +10,207 @@ from enum import Enum
 # ~ crosscode eventscript v1.5.0 parser, by EL ~
 # to run:
 #   python cc-eventscript-parser.py <input text file>
+# or, to start up faster, as the module's bytecode is cached rather than compiled on every run:
+#   python -m cc_eventscript_parser <input text file>
 # REQUIRES PYTHON 3.10 OR ABOVE!
 # to make a text file:
 #   see readme
 
 verbose = False
+parserVersion = "1.5.0"
+# the version of what builds produce. build caches and symbol indexes made with another version are
+# discarded, so bump this with any change to the output, the cache or the index, even without a release.
+cacheVersion = 2
+# set to a BuildProfiler to collect timings, otherwise nothing is measured
+profiler = None
+# shares identical steps between events when set, see --share-steps
+interner: Events.StepInterner | None = None
+# set to a StepOptimizer to optimize the steps of every message, see -O. CCOptimizer is only imported then.
+optimizer: "CCOptimizer.StepOptimizer | None" = None
+# set to a Diagnostics to report every error and carry on parsing, see --diagnostics
+diagnostics = None
+# how often input files are checked for changes in watch mode, in seconds
+watchInterval = 0.2
 
 class CCES_Exception(Exception): pass
 
+class LazyPattern:
+    # a regular expression that isn't compiled until it's first used, so that starting up only pays for
+    # the patterns a run actually needs. its source and flags are available without compiling it.
+    def __init__(self, pattern: str, flags: int = 0) -> None:
+        self.pattern: str = pattern
+        self.flags: int = flags
+
+    def __getattr__(self, name: str):
+        # only reached for attributes of the compiled pattern, such as match. they're kept afterwards,
+        # so every later use is a plain attribute lookup.
+        if name.startswith("_"): raise AttributeError(name)
+        value = getattr(re.compile(self.pattern, self.flags), name)
+        setattr(self, name, value)
+        return value
+
 class CCEventRegex:
     # matches lines that start with "#" or "//"
-    comment = re.compile(r"(?<!\\)(?:#|\/\/).*")
+    comment = LazyPattern(r"(?<!\\)(?:#|\/\/).*")
     # matches strings of the form "import (fileName)"
-    importFile = re.compile(r"^import\s+(?:(?:\.\/)?patches\/)?(?P<directory>(?:[.\w]+[\\\/])*)(?P<filename>[\w+-]+){1}?(?:\.json)?$", flags=re.I)
-    includeFile = re.compile(r"^include\s+(?:(?:\.\/)?patches\/)?(?P<directory>(?:[.\w]+[\\\/])*)(?P<filename>[\w+-]+){1}?(?:\.json)?$", flags=re.I)
+    importFile = LazyPattern(r"^import\s+(?:(?:\.\/)?patches\/)?(?P<directory>(?:[.\w]+[\\\/])*)(?P<filename>[\w+-]+){1}?(?:\.json)?$", flags=re.I)
+    includeFile = LazyPattern(r"^include\s+(?:(?:\.\/)?patches\/)?(?P<directory>(?:[.\w]+[\\\/])*)(?P<filename>[\w+-]+){1}?(?:\.json)?$", flags=re.I)
     
-    filepath = re.compile(r"^(?P<directory>(?:[.\w]+[\\\/])*)(?P<filename>\S+)$")
+    filepath = LazyPattern(r"^(?P<directory>(?:[.\w]+[\\\/])*)(?P<filename>\S+)$")
     # matches strings of the form "(character) > (expression): (message)" or "(character) > (expression) (message)"
-    dialogue = re.compile(r"^(?P<character>.+)\s*>\s*(?P<expression>[A-Z\d_]+)[\s:](?P<dialogue>.+)$")
+    dialogue = LazyPattern(r"^(?P<character>.+)\s*>\s*(?P<expression>[A-Z\d_]+)[\s:](?P<dialogue>.+)$")
     # matches strings of the form "message (number)", insensitive search
-    eventHeader = re.compile(r"^(?:message|event) (?P<eventNum>\d+):?$", flags=re.I)
+    eventHeader = LazyPattern(r"^(?:message|event) (?P<eventNum>\d+):?$", flags=re.I)
     # matches strings of the form "== title =="
-    title = re.compile(r"^== *(?P<ignore>!)?(?P<eventTitle>\S+) *==$")
+    title = LazyPattern(r"^== *(?P<ignore>!)?(?P<eventTitle>\S+) *==$")
     # matches strings of the form "(key): (value)"
-    property = re.compile(r"^(?P<property>\w+)\s*:\s*(?P<value>.+)$")
+    property = LazyPattern(r"^(?P<property>\w+)\s*:\s*(?P<value>.+)$")
     # matches "set (varname) (true/false)"
-    setVarBool = re.compile(r"^set\s+(?P<varName>\S+)\s*(?P<sign>[= |^])\s*(?P<value>true|false)$", flags=re.I)
+    setVarBool = LazyPattern(r"^set\s+(?P<varName>\S+)\s*(?P<sign>[= |^])\s*(?P<value>true|false)$", flags=re.I)
     # matches "set (varname) (+/-/=) (number)"
-    setVarNum = re.compile(r"^set\s+(?P<varName>\S+)\s*(?P<operation>[=+\-*/%|^])\s*(?P<value>\d+)$", flags=re.I)
+    setVarNum = LazyPattern(r"^set\s+(?P<varName>\S+)\s*(?P<operation>[=+\-*/%|^])\s*(?P<value>\d+)$", flags=re.I)
 
-    label = re.compile(r"label +(?P<name>\S+)", flags=re.I)
-    gotoLabel = re.compile(r"goto +(?P<name>\S+)(?: +if +(?P<condition>.+))?", flags=re.I)
+    label = LazyPattern(r"label +(?P<name>\S+)", flags=re.I)
+    gotoLabel = LazyPattern(r"goto +(?P<name>\S+)(?: +if +(?P<condition>.+))?", flags=re.I)
 
-    propertyType = re.compile(r"^type(?:\.(?P<property>\S+))?\s*:\s*(?P<value>.+)", flags = re.I)
-    listOfNumbers = re.compile(r"^(?:\d+,\s*)+")
-    listOfStrings = re.compile(r"^(?:\S+,\s*)+")
+    propertyType = LazyPattern(r"^type(?:\.(?P<property>\S+))?\s*:\s*(?P<value>.+)", flags = re.I)
+    listOfNumbers = LazyPattern(r"^(?:\d+,\s*)+")
+    listOfStrings = LazyPattern(r"^(?:\S+,\s*)+")
 
     # matches "if (condition)", "else", and  "endif" respectively
-    ifStatement = re.compile(r"^if (?P<condition>.+)", flags=re.I)
-    elseStatement = re.compile(r"^else$", flags=re.I)
-    endifStatement = re.compile(r"^endif$", flags=re.I)
+    ifStatement = LazyPattern(r"^if (?P<condition>.+)", flags=re.I)
+    elseStatement = LazyPattern(r"^else$", flags=re.I)
+    endifStatement = LazyPattern(r"^endif$", flags=re.I)
+
+class TokenType(Enum):
+    IMPORT = 1
+    INCLUDE = 2
+    TITLE = 3
+    EVENT_HEADER = 4
+    PROPERTY_TYPE = 5
+    PROPERTY = 6
+    IF = 7
+    ENDIF = 8
+    ELSE = 9
+    DIALOGUE = 10
+    SET_VAR_BOOL = 11
+    SET_VAR_NUM = 12
+    LABEL = 13
+    GOTO_LABEL = 14
+    UNKNOWN = 15
+
+class Token:
+    __slots__ = ("tokenType", "lineNumber", "line", "values")
+
+    def __init__(self, tokenType: TokenType, lineNumber: int, line: str, values: tuple = ()) -> None:
+        self.tokenType: TokenType = tokenType
+        self.lineNumber: int = lineNumber
+        self.line: str = line
+        # the named groups of the matching pattern, in the order they appear in it.
+        self.values: tuple = values
+
+class CCEventLexer:
+    # the pattern each token type is matched with.
+    tokenPatterns: dict[TokenType, LazyPattern] = {
+        TokenType.IMPORT: CCEventRegex.importFile,
+        TokenType.INCLUDE: CCEventRegex.includeFile,
+        TokenType.TITLE: CCEventRegex.title,
+        TokenType.EVENT_HEADER: CCEventRegex.eventHeader,
+        TokenType.PROPERTY_TYPE: CCEventRegex.propertyType,
+        TokenType.PROPERTY: CCEventRegex.property,
+        TokenType.IF: CCEventRegex.ifStatement,
+        TokenType.ENDIF: CCEventRegex.endifStatement,
+        TokenType.ELSE: CCEventRegex.elseStatement,
+        TokenType.DIALOGUE: CCEventRegex.dialogue,
+        TokenType.SET_VAR_BOOL: CCEventRegex.setVarBool,
+        TokenType.SET_VAR_NUM: CCEventRegex.setVarNum,
+        TokenType.LABEL: CCEventRegex.label,
+        TokenType.GOTO_LABEL: CCEventRegex.gotoLabel,
+    }
+
+    # the token types recognized in each part of a file, in order of precedence.
+    # lines of ignored ("== !title ==") events only need to be checked for file-level tokens.
+    fileTokens = (TokenType.IMPORT, TokenType.INCLUDE, TokenType.TITLE)
+    headerTokens = fileTokens + (TokenType.EVENT_HEADER, TokenType.PROPERTY_TYPE, TokenType.PROPERTY)
+    messageTokens = fileTokens + (TokenType.EVENT_HEADER, TokenType.IF, TokenType.ENDIF, TokenType.ELSE,
+        TokenType.DIALOGUE, TokenType.SET_VAR_BOOL, TokenType.SET_VAR_NUM, TokenType.LABEL, TokenType.GOTO_LABEL)
+
+    @staticmethod
+    def buildPattern(tokenTypes: tuple[TokenType, ...]) -> "LexerPattern":
+        # joins the patterns into a single alternation, so each line is matched only once.
+        # every pattern is wrapped in a group named after its token type, and its own groups are
+        # prefixed with that name so they stay unique.
+        alternatives: list[str] = []
+        for tokenType in tokenTypes:
+            pattern = CCEventLexer.tokenPatterns[tokenType]
+            source = re.sub(r"\(\?P<(\w+)>", rf"(?P<{tokenType.name}_\1>", pattern.pattern)
+            if pattern.flags & re.I: source = f"(?i:{source})"
+            alternatives.append(f"(?P<{tokenType.name}>{source})")
+        return LexerPattern("|".join(alternatives))
+
+class LexerPattern(LazyPattern):
+    # the combined pattern of one part of a file. its token table maps the index of each token type's
+    # group to the token type and the number of groups in that type's own pattern, so a match can be
+    # read straight from its lastindex.
+    def __getattr__(self, name: str):
+        if name != "tokens": return super().__getattr__(name)
+        outerGroups = sorted((index, TokenType[groupName]) for groupName, index in self.groupindex.items() if groupName in TokenType.__members__)
+        ends = [index for index, _ in outerGroups[1:]] + [self.groups + 1]
+        self.tokens: dict[int, tuple[TokenType, int]] = {index: (tokenType, end - index - 1) for (index, tokenType), end in zip(outerGroups, ends)}
+        return self.tokens
+
+CCEventLexer.filePattern = CCEventLexer.buildPattern(CCEventLexer.fileTokens)
+CCEventLexer.headerPattern = CCEventLexer.buildPattern(CCEventLexer.headerTokens)
+CCEventLexer.messagePattern = CCEventLexer.buildPattern(CCEventLexer.messageTokens)
+
+
+class EventSelection:
+    # picks which events are built by their titles, as they appear in output filenames.
+    # an event is selected if it matches any "only" pattern (or there are none) and no "exclude" pattern.
+    def __init__(self, only: list[str] | None = None, exclude: list[str] | None = None) -> None:
+        self.onlyPattern: re.Pattern | None = _globPattern(only)
+        self.excludePattern: re.Pattern | None = _globPattern(exclude)
+
+    def selects(self, eventTitle: str) -> bool:
+        eventTitle = eventTitle.replace("/", ".")
+        if self.onlyPattern is not None and not self.onlyPattern.match(eventTitle): return False
+        return self.excludePattern is None or not self.excludePattern.match(eventTitle)
+
+
+def tokenize(text: str | Iterable[str], stripComments: bool = True, selection: EventSelection | None = None,
+        onMatch: Callable[[LexerPattern, TokenType | None], None] | None = None) -> Iterator[Token]:
+    # the lexer starts out expecting event properties, switches to message steps after a
+    # "message (number)" header, and back to properties (or skipping) after a title.
+    # the lines of events that aren't selected are skipped just like those of ignored events.
+    # the text may also be given as its lines, such as an open file, so that it's never all held at once.
+    # onMatch is told which pattern each line was tried against and the token type it matched, if any.
+    pattern = CCEventLexer.headerPattern
+    if isinstance(text, str):
+        # comments never span lines, so they can be stripped from the whole text at once.
+        if stripComments: text = CCEventRegex.comment.sub("", text)
+        lines = text.split("\n")
+    else:
+        lines = (CCEventRegex.comment.sub("", line) for line in text) if stripComments else text
+    for lineNumber, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line: continue
+
+        if match := pattern.match(line):
+            # the outer group is the last one to close, and the groups of its pattern directly follow it.
+            groupStart = match.lastindex
+            tokenType, groupCount = pattern.tokens[groupStart]
+            if onMatch is not None: onMatch(pattern, tokenType)
+            values = match.groups()[groupStart:groupStart + groupCount]
+            if tokenType is TokenType.TITLE:
+                skipEvent = values[0] or (selection is not None and not selection.selects(values[1]))
+                pattern = CCEventLexer.filePattern if skipEvent else CCEventLexer.headerPattern
+            elif tokenType is TokenType.EVENT_HEADER:
+                pattern = CCEventLexer.messagePattern
+            yield Token(tokenType, lineNumber, line, values)
+        else:
+            if onMatch is not None: onMatch(pattern, None)
+            if pattern is not CCEventLexer.filePattern: yield Token(TokenType.UNKNOWN, lineNumber, line)
+
 
 class EventItemType(Enum):
     STANDARD_EVENT = 1
@@ -55,11 +218,18 @@ class EventItemType(Enum):
     INCLUDE = 3
 
 class EventItem:
+    # a streaming build keeps one of these for every event, so they're kept small
+    __slots__ = ("eventType", "filepath", "event", "sourceHash", "selected")
+
     def __init__(self, eventType, filePath: str, event: Events.CommonEvent | None = None) -> None:
         self.eventType = eventType
         if not CCEventRegex.filepath.match(filePath): raise CCES_Exception(f"Error: Invalid file path {filePath}!")
         self.filepath = filePath
         self.event = event
+        # the hash of the event's contents, only set when building with a cache
+        self.sourceHash: str | None = None
+        # whether the event was built, or only its title was recorded
+        self.selected: bool = True
 
     def genPatchStep(self) -> dict:
         fixedFilename = re.sub(r"^(\.\/)","mod:", self.filepath)
@@ -78,77 +248,306 @@ class EventItem:
                 raise CCES_Exception("Unknown patch type!")
 
 
-def processDialogue(inputString: str) -> Events.SHOW_SIDE_MSG:
-    messageMatch = CCEventRegex.dialogue.match(inputString)
-    character = CCUtils.Character(*messageMatch.group("character", "expression"))
-    message = messageMatch.group("dialogue").replace("\\n","\n")
+class BuildCache:
+    # remembers what previous builds produced, so that unchanged files don't have to be read
+    # and unchanged events don't have to be parsed or written again.
+    # the whole cache is discarded if the cache version, output indentation or optimization changes.
+    # a cache without a filename is only kept in memory.
+    def __init__(self, filename: str | None, indentation = None, optimize: bool = False) -> None:
+        self.filename: str | None = filename
+        self.settings: dict = {"cacheVersion": cacheVersion, "indentation": indentation, "optimize": optimize}
+        # source file -> its stats and the items found in it
+        self.files: dict[str, dict] = {}
+        # event title -> hash of its contents and the stats of its output file
+        self.events: dict[str, dict] = {}
+        # only entries seen during this build are saved, so removed files and events are dropped.
+        self.newFiles: dict[str, dict] = {}
+        self.newEvents: dict[str, dict] = {}
+
+        if filename is not None and os.path.isfile(filename):
+            try:
+                with open(filename, "r", encoding = "utf8") as cacheFile:
+                    cacheData = json.load(cacheFile)
+            except (OSError, ValueError):
+                print(f"Could not read build cache '{filename}', ignoring...", file = sys.stderr)
+                return
+            if cacheData.get("settings") == self.settings:
+                self.files = cacheData["files"]
+                self.events = cacheData["events"]
+
+    @staticmethod
+    def fileStats(filename: str) -> list[int] | None:
+        try:
+            stats = os.stat(filename)
+        except OSError:
+            return None
+        return [stats.st_mtime_ns, stats.st_size]
+
+    @staticmethod
+    def hashEvent(eventTitle: str, eventTokens: list[Token]) -> str:
+        import hashlib
+        eventHash = hashlib.sha256(eventTitle.encode("utf8"))
+        for token in eventTokens:
+            eventHash.update(b"\n" + token.line.encode("utf8"))
+        return eventHash.hexdigest()
+
+    def outputUpToDate(self, eventTitle: str) -> bool:
+        entry = self.events.get(eventTitle)
+        if entry is None: return False
+        return entry["output"] is None or entry["output"] == BuildCache.fileStats(entry["filepath"])
+
+    def fileUpToDate(self, filename: str) -> bool:
+        entry = self.files.get(filename)
+        if entry is None or entry["stats"] != BuildCache.fileStats(filename): return False
+        if not all(self.outputUpToDate(eventTitle) for eventTitle, eventType, _ in entry["items"] 
+                if eventType == EventItemType.STANDARD_EVENT.name):
+            return False
+
+        self.newFiles[filename] = entry
+        for eventTitle, eventType, _ in entry["items"]:
+            if eventType == EventItemType.STANDARD_EVENT.name: self.newEvents[eventTitle] = self.events[eventTitle]
+        return True
+
+    def eventUpToDate(self, eventTitle: str, eventHash: str) -> bool:
+        entry = self.events.get(eventTitle)
+        return entry is not None and entry["hash"] == eventHash and self.outputUpToDate(eventTitle)
+
+    def recordFile(self, filename: str, stats: list[int] | None, items: list[tuple[str, EventItem]]) -> None:
+        self.newFiles[filename] = {"stats": stats, "items": [[eventTitle, item.eventType.name, item.filepath] for eventTitle, item in items]}
+        for eventTitle, item in items:
+            if item.eventType != EventItemType.STANDARD_EVENT: continue
+            # events that weren't selected get no entry, so their file is read again by the next build
+            if not item.selected: continue
+            # events that were skipped as unchanged keep their previous entry
+            if item.event is None and item.sourceHash is not None:
+                self.newEvents[eventTitle] = self.events[eventTitle]
+            else:
+                self.newEvents[eventTitle] = {"hash": item.sourceHash, "filepath": item.filepath, "output": None}
+
+    def recordOutput(self, eventTitle: str) -> None:
+        entry = self.newEvents[eventTitle]
+        entry["output"] = BuildCache.fileStats(entry["filepath"])
+
+    def save(self) -> None:
+        # the entries of the finished build become the ones the next build is checked against
+        if self.filename is not None:
+            with open(self.filename, "w+", encoding = "utf8") as cacheFile:
+                json.dump({"settings": self.settings, "files": self.newFiles, "events": self.newEvents}, cacheFile)
+        self.files, self.events = self.newFiles, self.newEvents
+        self.newFiles, self.newEvents = {}, {}
+
+    def discardBuild(self) -> None:
+        self.newFiles, self.newEvents = {}, {}
+
+
+class BuildProfiler:
+    # collects the timings and statistics reported by --profile.
+    # every measurement is guarded by a check for the global profiler, so none of this runs otherwise.
+    phaseNames = ("reading", "comments", "tokenizing", "handleEvent", "processEvents", "serializing", "writing", "patchFile")
+    lexerNames = {CCEventLexer.headerPattern: "header", CCEventLexer.messagePattern: "message", CCEventLexer.filePattern: "skipped"}
+
+    def __init__(self, traceMemory: bool = False) -> None:
+        self.phases: dict[str, float] = {name: 0.0 for name in BuildProfiler.phaseNames}
+        self.files: list[dict] = []
+        self.events: dict[str, dict] = {}
+        # lexer pattern name -> lines it was tried against, lines it matched
+        self.patterns: dict[str, list[int]] = {}
+        # token type name -> lines the lexer read as that token
+        self.tokens: dict[str, int] = {}
+        self.traceMemory: bool = traceMemory
+        self.startTime: float = time.perf_counter()
+        self.totalTime: float = 0.0
+        self.peakMemory: int | None = None
+        if traceMemory:
+            import tracemalloc
+            tracemalloc.start()
+
+    def timed(self, phase: str, function):
+        def timedFunction(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.phases[phase] += time.perf_counter() - start
+        return timedFunction
+
+    def recordFile(self, filename: str, lineCount: int, duration: float, commentTime: float, parseTime: float) -> None:
+        self.phases["comments"] += commentTime
+        # the tokens are produced while the events are parsed, so tokenizing is whatever time is left
+        self.phases["tokenizing"] += duration - commentTime - parseTime
+        self.files.append({"file": filename, "lines": lineCount, "seconds": duration})
+
+    def recordEvent(self, eventTitle: str, filename: str, lineCount: int, duration: float) -> None:
+        self.phases["handleEvent"] += duration
+        self.events[eventTitle] = {"file": filename, "lines": lineCount, "parseSeconds": duration}
+
+    def recordOutput(self, eventTitle: str, serializeTime: float, writeTime: float) -> None:
+        self.phases["serializing"] += serializeTime
+        self.phases["writing"] += writeTime
+        entry = self.events.setdefault(eventTitle, {})
+        entry["serializeSeconds"] = serializeTime
+        entry["writeSeconds"] = writeTime
+
+    def countMatch(self, pattern: LexerPattern, tokenType: TokenType | None) -> None:
+        # given every line the lexer reads, so the counts are those of the build itself
+        counts = self.patterns.setdefault(BuildProfiler.lexerNames[pattern], [0, 0])
+        counts[0] += 1
+        if tokenType is None: return
+        counts[1] += 1
+        self.tokens[tokenType.name] = self.tokens.get(tokenType.name, 0) + 1
+
+    def finish(self) -> None:
+        self.totalTime = time.perf_counter() - self.startTime
+        if self.traceMemory:
+            import tracemalloc
+            self.peakMemory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+    def asDict(self) -> dict:
+        return {
+            "parserVersion": parserVersion,
+            "totalSeconds": self.totalTime,
+            "peakMemory": self.peakMemory,
+            "phases": self.phases,
+            "files": self.files,
+            "events": self.events,
+            "patterns": {name: {"tested": tested, "matched": matched} for name, (tested, matched) in self.patterns.items()},
+            "tokens": self.tokens
+        }
+
+    def printSummary(self, file = sys.stdout) -> None:
+        print(f"Total: {self.totalTime * 1000:.2f} ms", file = file)
+        for name, duration in self.phases.items():
+            note = " (part of handleEvent)" if name == "processEvents" else ""
+            print(f"  {name:>13}: {duration * 1000:10.2f} ms{note}", file = file)
+        slowestEvents = sorted(self.events.items(), key = lambda item: item[1].get("parseSeconds", 0), reverse = True)[:5]
+        if slowestEvents: print("Slowest events:", file = file)
+        for eventTitle, entry in slowestEvents:
+            print(f"  {eventTitle}: {entry.get('lines', 0)} lines, {entry.get('parseSeconds', 0) * 1000:.2f} ms", file = file)
+        if self.patterns: print("Lexer patterns (tested/matched):", file = file)
+        for name, (tested, matched) in self.patterns.items():
+            print(f"  {name:>14}: {tested:8} / {matched:<8}", file = file)
+        if self.tokens: print("Tokens:", file = file)
+        for name, count in sorted(self.tokens.items(), key = lambda item: item[1], reverse = True):
+            print(f"  {name:>14}: {count:8}", file = file)
+        if self.peakMemory is not None:
+            print(f"Peak memory: {self.peakMemory / 1024 / 1024:.2f} MiB", file = file)
+
+
+class Diagnostics:
+    # collects every error and warning of a build for --diagnostics, rather than stopping at the first error.
+    # the parser keeps the file, event title and message number up to date, so each one is reported with them.
+    def __init__(self) -> None:
+        self.entries: list[dict] = []
+        self.filename: str | None = None
+        self.eventTitle: str | None = None
+        self.message: int | None = None
+
+    def report(self, severity: str, text: str, lineNumber: int | None = None) -> None:
+        self.entries.append({
+            "severity": severity,
+            "message": text.removeprefix("Error: "),
+            "file": self.filename,
+            "line": lineNumber,
+            "event": self.eventTitle,
+            "messageNumber": self.message
+        })
+
+    def reportError(self, error: Exception, lineNumber: int | None = None) -> None:
+        # a KeyError's message would otherwise be quoted
+        self.report("error", error.args[0] if isinstance(error, KeyError) and error.args else str(error) or type(error).__name__, lineNumber)
+
+    @property
+    def errorCount(self) -> int:
+        return sum(1 for entry in self.entries if entry["severity"] == "error")
+
+    @staticmethod
+    def formatEntry(entry: dict) -> str:
+        location = entry["file"] or "<input>"
+        if entry["line"] is not None: location += f":{entry['line']}"
+        context = []
+        if entry["event"] is not None: context.append(f"event '{entry['event']}'")
+        if entry["messageNumber"] is not None: context.append(f"message {entry['messageNumber']}")
+        return f"{location}: {entry['severity']}: {entry['message']}" + (f" ({', '.join(context)})" if context else "")
+
+    def asDict(self) -> dict:
+        return {
+            "parserVersion": parserVersion,
+            "errors": self.errorCount,
+            "warnings": len(self.entries) - self.errorCount,
+            "diagnostics": self.entries
+        }
+
+    def printSummary(self, file = sys.stderr) -> None:
+        for entry in self.entries: print(Diagnostics.formatEntry(entry), file = file)
+        print(f"{self.errorCount} errors, {len(self.entries) - self.errorCount} warnings.", file = file)
+
+
+def recoverFrom(error: Exception, lineNumber: int | None = None, diagnostics: Diagnostics | None = None) -> None:
+    # raises the error as usual, unless diagnostics are being collected, in which case it's recorded and parsing goes on
+    if diagnostics is None: raise error
+    diagnostics.reportError(error, lineNumber)
+
+def warn(text: str, lineNumber: int | None = None, diagnostics: Diagnostics | None = None) -> None:
+    if diagnostics is None: print(text, file = sys.stderr)
+    else: diagnostics.report("warning", text, lineNumber)
+
+
+def processDialogue(characterName: str, expression: str, dialogue: str) -> Events.SHOW_SIDE_MSG:
+    character = CCUtils.Character.intern(characterName, expression)
+    message = dialogue.replace("\\n","\n")
 
     messageEvent = Events.SHOW_SIDE_MSG(character, message)
     return messageEvent
 
 
-def processEvents(eventStrs: list[str]) -> list[Events.Event_Step]:
+def processEvents(eventTokens: list[Token], diagnostics: Diagnostics | None = None,
+        optimizer: "CCOptimizer.StepOptimizer | None" = None) -> list[Events.Event_Step]:
+    # errors are collected by diagnostics, if given, and the steps are optimized by optimizer, if given.
+    # neither is taken from the module, so that sources with different settings can be parsed at the same time.
     workingEvent: list[Events.Event_Step] = []
-    ifCount: int = 0
-    inIf: bool = False
-    hasElse: bool = False
-    buffer: list[str] = []
+    # steps are always added to the innermost open block.
+    # each open "if" is kept alongside the list of steps it was added to, and its token for diagnostics.
+    ifStack: list[tuple[Events.IF, list[Events.Event_Step], Token]] = []
+    currentSteps: list[Events.Event_Step] = workingEvent
+
+    for token in eventTokens:
+        tokenType = token.tokenType
 
-    for line in eventStrs:
-        line = line.strip()
-        
         # if (condition)
-        if match := CCEventRegex.ifStatement.match(line):
-            if not inIf:
-                ifEvent = Events.IF(match.group("condition"))
-                inIf = True
-            else:
-                buffer.append(line)
-            ifCount += 1
+        if tokenType is TokenType.IF:
+            ifEvent = Events.IF(token.values[0], thenEvent = [], elseEvent = [])
+            currentSteps.append(ifEvent)
+            ifStack.append((ifEvent, currentSteps, token))
+            currentSteps = ifEvent.thenStep
 
         # endif
-        elif CCEventRegex.endifStatement.match(line):
-            # only count the last "endif" of a block
-            if ifCount > 1:
-                buffer.append(line)
-                ifCount -= 1
+        elif tokenType is TokenType.ENDIF:
             # make sure that there is no excess endifs
-            elif ifCount < 1:
-                raise CCES_Exception("Error: 'endif' found outside of if block")
-            # process if statement for the corresponding if
-            else:
-                if hasElse: ifEvent.elseStep = processEvents(buffer)
-                else: ifEvent.thenStep = processEvents(buffer)
-                ifCount = 0
-                workingEvent.append(ifEvent)
-                inIf = False
-                hasElse = False
-                buffer = []
+            if not ifStack:
+                recoverFrom(CCES_Exception("Error: 'endif' found outside of if block"), token.lineNumber, diagnostics)
+                continue
+            # go back to the block that contains the if statement
+            currentSteps = ifStack.pop()[1]
 
         # else
-        elif CCEventRegex.elseStatement.match(line):
-            if (not inIf):
-                raise CCES_Exception("'else' statement found outside of if block")
-            elif ifCount > 1:
-                buffer.append(line)
-            elif hasElse:
-                raise CCES_Exception("multiple 'else' statements found inside of if block")
-            else:
-                hasElse = True
-                ifEvent.thenStep = processEvents(buffer)
-                buffer = []
-
-        # adds to string buffer for later processing
-        elif inIf:
-            buffer.append(line)
+        elif tokenType is TokenType.ELSE:
+            if not ifStack:
+                recoverFrom(CCES_Exception("'else' statement found outside of if block"), token.lineNumber, diagnostics)
+                continue
+            ifEvent = ifStack[-1][0]
+            if currentSteps is ifEvent.elseStep:
+                recoverFrom(CCES_Exception("multiple 'else' statements found inside of if block"), token.lineNumber, diagnostics)
+                continue
+            currentSteps = ifEvent.elseStep
 
         # dialogue
-        elif match := CCEventRegex.dialogue.match(line):
-            workingEvent.append(processDialogue(line))
+        elif tokenType is TokenType.DIALOGUE:
+            currentSteps.append(processDialogue(*token.values))
 
         # set var = bool
-        elif match := CCEventRegex.setVarBool.match(line):
-            varName, sign, originalValue = match.group("varName", "sign", "value")
+        elif tokenType is TokenType.SET_VAR_BOOL:
+            varName, sign, originalValue = token.values
             value = (originalValue.lower() == "true")
             operation: ChangeVarType
             match sign:
@@ -159,11 +558,11 @@ def processEvents(eventStrs: list[str]) -> list[Events.Event_Step]:
                 case "^":
                     operation = Events.ChangeVarType.XOR 
 
-            workingEvent.append(Events.CHANGE_VAR_BOOL(varName, value, operation))
+            currentSteps.append(Events.CHANGE_VAR_BOOL(varName, value, operation))
 
         # set var +|-|= num
-        elif match := CCEventRegex.setVarNum.match(line):
-            varName, sign, number = match.group("varName", "operation", "value")
+        elif tokenType is TokenType.SET_VAR_NUM:
+            varName, sign, number = token.values
             value = int(number)
             operation: ChangeVarType
             match sign:
@@ -183,37 +582,50 @@ def processEvents(eventStrs: list[str]) -> list[Events.Event_Step]:
                     operation = ChangeVarType.OR
                 case "^":
                     operation = Events.ChangeVarType.XOR 
-            workingEvent.append(Events.CHANGE_VAR_NUMBER(varName, value, operation))
+            currentSteps.append(Events.CHANGE_VAR_NUMBER(varName, value, operation))
 
-        elif match := CCEventRegex.label.match(line):
-            workingEvent.append(Events.LABEL(match.group("name")))
+        elif tokenType is TokenType.LABEL:
+            currentSteps.append(Events.LABEL(token.values[0]))
 
-        elif match := CCEventRegex.gotoLabel.match(line):
-            if match.group("condition"): # if a condition exists, it will do GOTO_LABEL_WHILE instead.
-                workingEvent.append(Events.GOTO_LABEL_WHILE(*match.group("name", "condition")))
+        elif tokenType is TokenType.GOTO_LABEL:
+            labelName, condition = token.values
+            if condition: # if a condition exists, it will do GOTO_LABEL_WHILE instead.
+                currentSteps.append(Events.GOTO_LABEL_WHILE(labelName, condition))
             else:
-                workingEvent.append(Events.GOTO_LABEL(match.group("name")))
+                currentSteps.append(Events.GOTO_LABEL(labelName))
+
+        # lines that didn't match anything are otherwise dropped without a word
+        elif tokenType is TokenType.UNKNOWN and diagnostics is not None:
+            diagnostics.report("warning", f"Unrecognized line \"{token.line}\", ignoring...", token.lineNumber)
 
     #ensure that ifs are properly terminated
-    if inIf:
-        raise CCES_Exception("'if' found without corresponding 'endif'")
+    for ifEvent, _, ifToken in ifStack:
+        recoverFrom(CCES_Exception("'if' found without corresponding 'endif'"), ifToken.lineNumber, diagnostics)
 
+    if optimizer is not None: workingEvent = optimizer.optimizeSteps(workingEvent)
+    if interner is not None: return interner.internSteps(workingEvent)
     return workingEvent
 
 
-def handleEvent(eventStrs: list[str]) -> Events.CommonEvent:
+def handleEvent(eventTokens: list[Token], diagnostics: Diagnostics | None = None,
+        optimizer: "CCOptimizer.StepOptimizer | None" = None) -> Events.CommonEvent:
+    # diagnostics and optimizer are handed on to processEvents.
     event = Events.CommonEvent(type={}, loopCount = 3)
 
     eventNumber: int = 0
-    buffer: list[str] = []
+    buffer: list[Token] = []
     trackMessages: bool = False
     workingEvent = {}
+    process = processEvents if profiler is None else profiler.timed("processEvents", processEvents)
+    if diagnostics is not None: diagnostics.message = None
 
-    for line in eventStrs:
-        if match := CCEventRegex.eventHeader.match(line):
+    for token in eventTokens:
+        tokenType = token.tokenType
+        if tokenType is TokenType.EVENT_HEADER:
             if trackMessages:
+                if diagnostics is not None: diagnostics.message = eventNumber
                 try:
-                    workingEvent.thenStep = processEvents(buffer)
+                    workingEvent.thenStep = process(buffer, diagnostics, optimizer)
                 except CCES_Exception as e:
                     raise CCES_Exception(f"error in event {eventNumber}") from e
                 event.event[eventNumber] = workingEvent
@@ -224,10 +636,10 @@ def handleEvent(eventStrs: list[str]) -> Events.CommonEvent:
             trackMessages = True
 
         elif trackMessages:
-            buffer.append(line) 
+            buffer.append(token) 
 
-        elif match := CCEventRegex.propertyType.match(line):
-            propertyName, propertyValue = match.group("property", "value")
+        elif tokenType is TokenType.PROPERTY_TYPE:
+            propertyName, propertyValue = token.values
             propertyValue = propertyValue.strip()
             if propertyName is not None:
                 
@@ -247,8 +659,8 @@ def handleEvent(eventStrs: list[str]) -> Events.CommonEvent:
             else:
                 event.type["type"] = propertyValue
 
-        elif match := CCEventRegex.property.match(line):
-            propertyName, propertyValue = match.group("property", "value")
+        elif tokenType is TokenType.PROPERTY:
+            propertyName, propertyValue = token.values
             propertyName = propertyName.lower()
             
             match propertyName:
@@ -256,14 +668,19 @@ def handleEvent(eventStrs: list[str]) -> Events.CommonEvent:
                 case "repeat": event.repeat = propertyValue
                 case "condition": event.condition = propertyValue
                 case "eventtype": event.eventType = propertyValue
-                case "loopcount": event.loopCount = int(propertyValue)
-                case _: print(f"Unrecognized property \"{propertyName}\", skipping...", file = sys.stderr)
+                case "loopcount":
+                    try:
+                        event.loopCount = int(propertyValue)
+                    except ValueError as e:
+                        recoverFrom(e, token.lineNumber, diagnostics)
+                case _: warn(f"Unrecognized property \"{propertyName}\", skipping...", token.lineNumber, diagnostics)
 
         else:
-            print(f"Unrecognized line \"{line}\", ignoring...", file = sys.stderr)
+            warn(f"Unrecognized line \"{token.line}\", ignoring...", token.lineNumber, diagnostics)
     if buffer:
+        if diagnostics is not None: diagnostics.message = eventNumber
         try:
-            workingEvent.thenStep = processEvents(buffer)
+            workingEvent.thenStep = process(buffer, diagnostics, optimizer)
         except CCES_Exception as e:
             raise CCES_Exception(f"error in message {eventNumber}") from e
         event.event[eventNumber] = workingEvent
@@ -272,123 +689,834 @@ def handleEvent(eventStrs: list[str]) -> Events.CommonEvent:
     return event
 
 
-def parseFiles(inputFilenames: list[str], runRecursively: bool = False) -> dict[str, EventItem]:
-    eventDict: dict[str, EventItem] = {}
-    filelist: list[str] = []
-    def readFile(filename):
-        nonlocal eventDict
-        eventTitle: str = ""
-        buffer: list[str] = []
-        ignoreEvent: bool = False
+def addEventItem(eventDict: dict[str, EventItem], eventTitle: str, item: EventItem) -> None:
+    if eventTitle in eventDict:
+        if item.eventType == EventItemType.STANDARD_EVENT: raise KeyError("Duplicate event name found in input file.")
+        raise KeyError(f"Duplicate event name '{eventTitle}' found in input file.")
+    eventDict[eventTitle] = item
+
+
+def mergeItems(eventDict: dict[str, EventItem], filename: str, items: list[tuple[str, EventItem]], error: Exception | None) -> None:
+    if diagnostics is None:
+        for eventTitle, item in items: addEventItem(eventDict, eventTitle, item)
+    else:
+        # the first file to use a title keeps it
+        diagnostics.filename, diagnostics.message = filename, None
+        for eventTitle, item in items:
+            diagnostics.eventTitle = eventTitle
+            try:
+                addEventItem(eventDict, eventTitle, item)
+            except KeyError as e:
+                diagnostics.reportError(e)
+        if error is not None:
+            diagnostics.eventTitle = None
+            diagnostics.reportError(error)
+            return
+    try:
+        if error is not None: raise error
+    except CCES_Exception as e:
+        raise Exception(f"Error in {filename}: ") from e
+
+
+def _recordTokens(tokens: Iterable[Token], fileTokens: list[Token]) -> Iterator[Token]:
+    for token in tokens:
+        fileTokens.append(token)
+        yield token
+
+
+def readFile(filename: str, cache: BuildCache | None = None, selection: EventSelection | None = None,
+        onEvent: Callable[[str, EventItem], None] | None = None, streaming: bool = False,
+        onTokens: Callable[[str, list[Token]], None] | None = None) -> tuple[list[tuple[str, EventItem]], Exception | None]:
+    # when streaming, the file is parsed line by line as it's read. the profiler needs the whole text.
+    if streaming and profiler is None:
+        try:
+            inputFile = open(filename, "r", encoding = "utf8")
+        except Exception as e:
+            return [], e
+        with inputFile:
+            return parseSource(inputFile, filename, cache, selection, onEvent, onTokens)
+    try:
+        if profiler is not None: readStart = time.perf_counter()
         with open(filename, "r", encoding='utf8') as inputFile:
-            for line in inputFile:
-                # remove comments and strip excess whitespace
-                line = re.sub(CCEventRegex.comment, "", line).strip()
+            text = inputFile.read()
+        if profiler is not None: profiler.phases["reading"] += time.perf_counter() - readStart
+    except Exception as e:
+        return [], e
+    return parseSource(text, filename, cache, selection, onEvent, onTokens)
 
-                # skip blank lines
-                if (not line): continue
-                
+
+def _buildSettings() -> tuple[Diagnostics | None, "CCOptimizer.StepOptimizer | None"]:
+    # the diagnostics and optimizer set on the module for the whole build
+    return diagnostics, optimizer
+
+def parseSource(text: str | Iterable[str], filename: str, cache: BuildCache | None = None, selection: EventSelection | None = None,
+        onEvent: Callable[[str, EventItem], None] | None = None, onTokens: Callable[[str, list[Token]], None] | None = None,
+        diagnostics: Diagnostics | None = None, optimizer: "CCOptimizer.StepOptimizer | None" = None) -> tuple[list[tuple[str, EventItem]], Exception | None]:
+    # any error is returned along with the items found before it, so that when files are merged,
+    # a duplicate title from an earlier file is still reported ahead of it.
+    # onEvent is given every event as soon as it's built, and onTokens every token of the file once it
+    # has been read without errors. a selection leaves out the lines of other events, so then there are
+    # no tokens to give.
+    # diagnostics and optimizer are used for this source in place of those of the build. they're handed
+    # down to every event rather than set on the module, so sources can be parsed with their own at the same time.
+    buildDiagnostics, buildOptimizer = _buildSettings()
+    return _parseSource(text, filename, cache, selection, onEvent, onTokens, buildDiagnostics if diagnostics is None else diagnostics,
+        buildOptimizer if optimizer is None else optimizer)
+
+def _parseSource(text: str | Iterable[str], filename: str, cache: BuildCache | None, selection: EventSelection | None,
+        onEvent: Callable[[str, EventItem], None] | None, onTokens: Callable[[str, list[Token]], None] | None, diagnostics: Diagnostics | None,
+        optimizer: "CCOptimizer.StepOptimizer | None") -> tuple[list[tuple[str, EventItem]], Exception | None]:
+    fileItems: dict[str, EventItem] = {}
+    eventTitle: str | None = None
+    ignoreEvent: bool = False
+    buffer: list[Token] = []
+
+    def closeEvent():
+        # check that the event isn't empty so it only runs if there's actually something there
+        if not buffer: return
+        item = fileItems[eventTitle]
+        if diagnostics is not None: diagnostics.eventTitle = eventTitle
+        if cache is not None:
+            item.sourceHash = BuildCache.hashEvent(eventTitle, buffer)
+            if cache.eventUpToDate(eventTitle, item.sourceHash):
+                if verbose: print(f"Skipping unchanged event '{eventTitle}'.")
+                return
+        if profiler is None:
+            item.event = handleEvent(buffer, diagnostics, optimizer)
+        else:
+            start = time.perf_counter()
+            item.event = handleEvent(buffer, diagnostics, optimizer)
+            profiler.recordEvent(eventTitle, filename, len(buffer) + 1, time.perf_counter() - start)
+        if onEvent is not None and item.event is not None: onEvent(eventTitle, item)
+
+    if diagnostics is not None: diagnostics.filename = filename
+    try:
+        if profiler is None:
+            tokens = tokenize(text, selection = selection)
+        else:
+            fileStart = time.perf_counter()
+            parseStart = profiler.phases["handleEvent"]
+            rawText = text
+            text = CCEventRegex.comment.sub("", text)
+            commentTime = time.perf_counter() - fileStart
+            tokens = tokenize(text, stripComments = False, selection = selection, onMatch = profiler.countMatch)
+        if onTokens is not None and selection is None:
+            fileTokens: list[Token] = []
+            tokens = _recordTokens(tokens, fileTokens)
+
+        for token in tokens:
+            match token.tokenType:
                 # handle file imports
-                if match := CCEventRegex.importFile.match(line):
-                    filename = f"./patches/{match.group('directory')}{match.group('filename')}.json"
-                    eventTitle = match.group("filename")
-                    if eventTitle in eventDict: raise KeyError(f"Duplicate event name '{eventTitle}' found in input file.")
-                    eventDict[eventTitle] = EventItem(EventItemType.IMPORT, filename)
-                    eventTitle = ""
-
-                if match := CCEventRegex.includeFile.match(line):
-                    filename = f"./patches/{match.group('directory')}{match.group('filename')}.json"
-                    eventTitle = match.group("filename")
-                    if eventTitle in eventDict: raise KeyError(f"Duplicate event name '{eventTitle}' found in input file.")
-                    eventDict[eventTitle] = EventItem(EventItemType.INCLUDE, filename)
-                    eventTitle = ""
-
-                elif match := CCEventRegex.title.match(line):
-                    # check that the event isn't empty so it only runs if there's actually something there
-                    if buffer: 
-                        eventDict[eventTitle].event = handleEvent(buffer)
-                        eventTitle = ""
+                case TokenType.IMPORT | TokenType.INCLUDE:
+                    directory, importName = token.values
+                    eventPath = f"./patches/{directory}{importName}.json"
+                    itemType = EventItemType.IMPORT if token.tokenType is TokenType.IMPORT else EventItemType.INCLUDE
+                    try:
+                        addEventItem(fileItems, importName, EventItem(itemType, eventPath))
+                    except KeyError as e:
+                        if diagnostics is not None: diagnostics.eventTitle, diagnostics.message = importName, None
+                        recoverFrom(e, token.lineNumber, diagnostics)
+
+                case TokenType.TITLE:
+                    if eventTitle is not None and not ignoreEvent: closeEvent()
 
                     # set the current event and clear the buffer
-                    eventTitle = match.group("eventTitle").replace("/",".")
-                    filename = f"./patches/{eventTitle}.json"
+                    ignore, eventTitle = token.values
+                    eventTitle = eventTitle.replace("/",".")
+                    eventPath = f"./patches/{eventTitle}.json"
                     buffer = []
-                    
-                    if match.group("ignore"):
+
+                    # the lexer already skips the lines of ignored events
+                    ignoreEvent = bool(ignore)
+                    if ignoreEvent: continue
+                    item = EventItem(EventItemType.STANDARD_EVENT, eventPath, None)
+                    # unselected events are still recorded, for duplicate titles and the patch file
+                    if selection is not None and not selection.selects(eventTitle):
+                        if verbose: print(f"Skipping unselected event '{eventTitle}'.")
+                        item.selected = False
+                        ignoreEvent = True
+                    try:
+                        addEventItem(fileItems, eventTitle, item)
+                    except KeyError as e:
+                        if diagnostics is not None: diagnostics.eventTitle, diagnostics.message = eventTitle, None
+                        recoverFrom(e, token.lineNumber, diagnostics)
+                        # the first event with the title is kept, so this one isn't parsed
                         ignoreEvent = True
+
+                # add anything else to the buffer
+                case _:
+                    if eventTitle is None:
+                        if diagnostics is not None: diagnostics.eventTitle, diagnostics.message = None, None
+                        recoverFrom(CCES_Exception(f"Error: line {token.lineNumber} is outside of an event"), token.lineNumber, diagnostics)
                         continue
-                    ignoreEvent = False
-                    if eventTitle in eventDict: raise KeyError("Duplicate event name found in input file.")
-                    eventDict[eventTitle] = EventItem(EventItemType.STANDARD_EVENT, filename, None)
+                    buffer.append(token)
 
-                # add anything missing to buffer
-                else:
-                    if not ignoreEvent: buffer.append(line)
+        # process any final events if one is present
+        if eventTitle is not None and not ignoreEvent: closeEvent()
+        if onTokens is not None and selection is None: onTokens(filename, fileTokens)
+        if profiler is not None:
+            profiler.recordFile(filename, rawText.count("\n") + 1, time.perf_counter() - fileStart, commentTime,
+                profiler.phases["handleEvent"] - parseStart)
+    except Exception as e:
+        return list(fileItems.items()), e
+    return list(fileItems.items()), None
 
-            # process any final events if one is present
-            if buffer: eventDict[eventTitle].event = handleEvent(buffer)
-    
-    
-    if runRecursively:
-        for item in os.listdir(inputFilenames[0]):
-            if (not item.startswith("!")) and re.match(r".*\.cces", item):
-                filelist.append(f"{inputFilenames[0]}/{item}")
+
+_workerCache: BuildCache | None = None
+_workerSelection: EventSelection | None = None
+
+def _initWorker(cache: BuildCache | None, verbosity: bool, selection: EventSelection | None = None, optimize: bool = False,
+        keepTokens: bool = False, measureSize: bool = False) -> None:
+    global _workerCache, _workerSelection, _workerKeepTokens, verbose, interner, optimizer
+    _workerCache = cache
+    _workerSelection = selection
+    _workerKeepTokens = keepTokens
+    verbose = verbosity
+    # which steps are shared isn't pickled along with them, so they're interned by the main process instead
+    interner = None
+    if optimize:
+        import CCOptimizer
+        optimizer = CCOptimizer.StepOptimizer(measureSize)
     else:
-        filelist = inputFilenames
-    for filename in filelist:
-        try: 
-            readFile(filename)
-        except CCES_Exception as e:
-            raise Exception(f"Error in {filename}: ") from e
+        optimizer = None
+
+def _readFileWorker(filename: str) -> tuple[list[tuple[str, EventItem]], list[Exception], str, str, dict | None, list[Token] | None]:
+    # output is captured so it can be printed in input order rather than interleaved.
+    # exceptions lose their causes when pickled, so the whole chain is sent back and relinked.
+    # the optimizer's counts for the file are sent back too, to be added to those of the main process,
+    # as are the file's tokens when they're wanted.
+    global optimizer
+    if optimizer is not None: optimizer = type(optimizer)(optimizer.measureSize)
+    fileTokens: list[Token] | None = None
+    def keepTokens(_, tokens: list[Token]) -> None:
+        nonlocal fileTokens
+        fileTokens = tokens
+    with contextlib.redirect_stdout(io.StringIO()) as output, contextlib.redirect_stderr(io.StringIO()) as errorOutput:
+        items, error = readFile(filename, _workerCache, _workerSelection, onTokens = keepTokens if _workerKeepTokens else None)
+    errorChain: list[Exception] = []
+    while error is not None:
+        errorChain.append(error)
+        error = error.__cause__
+    for error in errorChain: error.__cause__ = None
+    return items, errorChain, output.getvalue(), errorOutput.getvalue(), None if optimizer is None else optimizer.stats, fileTokens
+
+
+def _globPattern(globs: list[str]) -> re.Pattern | None:
+    # combines glob patterns into a single regular expression. like fnmatch, "*" also matches "/".
+    if not globs: return None
+    import fnmatch
+    return re.compile("|".join(fnmatch.translate(glob.replace("\\", "/")) for glob in globs))
+
+def iterInputFiles(root: str, include: list[str] | None = None, exclude: list[str] | None = None) -> Iterator[str]:
+    # walks a directory tree in name order, yielding the files whose path relative to the root matches
+    # an include pattern and no exclude pattern. entries starting with "!" are skipped, as are
+    # directories matching an exclude pattern.
+    includePattern = _globPattern(include if include is not None else ["*.cces"])
+    excludePattern = _globPattern(exclude)
+
+    def walk(directory: str, relativeDirectory: str) -> Iterator[str]:
+        with os.scandir(directory) as entries:
+            entries = sorted(entries, key = lambda entry: entry.name)
+        for entry in entries:
+            if entry.name.startswith("!"): continue
+            relativePath = relativeDirectory + entry.name
+            if excludePattern is not None and excludePattern.match(relativePath): continue
+            # symlinked directories aren't followed, so the walk can't loop
+            if entry.is_dir(follow_symlinks = False):
+                yield from walk(entry.path, relativePath + "/")
+            elif includePattern.match(relativePath) and entry.is_file():
+                yield entry.path
+
+    yield from walk(root, "")
+
+def findInputFiles(inputFilenames: list[str], runRecursively: bool = False, include: list[str] | None = None,
+        exclude: list[str] | None = None) -> list[str]:
+    # with runRecursively, every directory given is searched for input files and every file is used as-is.
+    if not runRecursively: return inputFilenames
+    filelist: list[str] = []
+    seen: set[str] = set()
+    for inputFilename in inputFilenames:
+        paths = iterInputFiles(inputFilename, include, exclude) if os.path.isdir(inputFilename) else [inputFilename]
+        for path in paths:
+            if path in seen: continue
+            seen.add(path)
+            filelist.append(path)
+    return filelist
+
+
+def parseFiles(inputFilenames: list[str], runRecursively: bool = False, cache: BuildCache | None = None, jobs: int = 1,
+        selection: EventSelection | None = None, onEvent: Callable[[str, EventItem], None] | None = None,
+        streaming: bool = False, onTokens: Callable[[str, list[Token]], None] | None = None, include: list[str] | None = None,
+        exclude: list[str] | None = None) -> dict[str, EventItem]:
+    # with runRecursively, directories are searched for input files, see findInputFiles.
+    # onEvent is given each built event once its whole file has been read without errors, so nothing is
+    # written for a file that fails the build. while streaming, events aren't held that long: each one is
+    # given as soon as it's built and its title is known not to clash with an earlier file's.
+    # onTokens is given the tokens of each file that was read, see parseSource.
+    eventDict: dict[str, EventItem] = {}
+    filelist: list[str] = findInputFiles(inputFilenames, runRecursively, include, exclude)
+
+    # files that haven't changed since the last build don't need to be read at all
+    staleFiles: list[bool] = [cache is None or not cache.fileUpToDate(filename) for filename in filelist]
+    fileStats: dict[str, list[int] | None] = {}
+    if cache is not None:
+        fileStats = {filename: BuildCache.fileStats(filename) for filename, stale in zip(filelist, staleFiles) if stale}
+    toRead: list[str] = [filename for filename, stale in zip(filelist, staleFiles) if stale]
+
+    executor = None
+    if jobs > 1 and len(toRead) > 1:
+        import concurrent.futures
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers = jobs, initializer = _initWorker, initargs = (cache, verbose, selection, optimizer is not None, onTokens is not None,
+            optimizer is not None and optimizer.measureSize))
+        results = executor.map(_readFileWorker, toRead)
+    else:
+        # a title that clashes with an earlier file's will fail the build once the file is merged
+        fileOnEvent = None if onEvent is None or not streaming else lambda eventTitle, item: eventTitle in eventDict or onEvent(eventTitle, item)
+        results = (readFile(filename, cache, selection, fileOnEvent, streaming, onTokens) for filename in toRead)
+
+    try:
+        # results are merged in input order, so the events and any errors come out the same as a serial build
+        for filename, stale in zip(filelist, staleFiles):
+            if not stale:
+                if verbose: print(f"Skipping unchanged file '{filename}'.")
+                for eventTitle, eventType, eventPath in cache.files[filename]["items"]:
+                    item = EventItem(EventItemType[eventType], eventPath)
+                    if item.eventType == EventItemType.STANDARD_EVENT: item.sourceHash = cache.events[eventTitle]["hash"]
+                    addEventItem(eventDict, eventTitle, item)
+                continue
+
+            if executor is not None:
+                items, errorChain, output, errorOutput, optimizerStats, fileTokens = next(results)
+                if optimizerStats is not None: optimizer.addStats(optimizerStats)
+                if fileTokens is not None: onTokens(filename, fileTokens)
+                sys.stdout.write(output)
+                sys.stderr.write(errorOutput)
+                error = None
+                for cause in reversed(errorChain):
+                    cause.__cause__ = error
+                    error = cause
+                if interner is not None:
+                    for _, item in items:
+                        if item.event is not None: interner.internEvent(item.event)
+            else:
+                items, error = next(results)
+
+            mergeItems(eventDict, filename, items, error)
+            if onEvent is not None and (executor is not None or not streaming):
+                for eventTitle, item in items:
+                    if item.event is not None: onEvent(eventTitle, item)
+            if cache is not None: cache.recordFile(filename, fileStats[filename], items)
+    finally:
+        if executor is not None: executor.shutdown(cancel_futures = True)
     return eventDict
 
-def generatePatchFile(events: dict[str, EventItem]) -> list[dict]:
+# ~ sharded builds ~
+# each shard builds some of the input files, and writes a manifest of the events in them.
+# CCShards.py merges the manifests of every shard into the patch file.
+
+def parseShard(text: str) -> tuple[int, int]:
+    # "i/N", where shards are numbered from 1 to N
+    from argparse import ArgumentTypeError
+    try:
+        index, count = (int(part) for part in text.split("/"))
+    except ValueError:
+        raise ArgumentTypeError(f"invalid shard '{text}', expected the form i/N")
+    if not 1 <= index <= count: raise ArgumentTypeError(f"invalid shard '{text}', i must be between 1 and N")
+    return index, count
+
+def defaultManifest(index: int, count: int) -> str:
+    return f"./cces-shard-{index}-of-{count}.json"
+
+def hashFilelist(filelist: list[str]) -> str:
+    # identifies the input of a sharded build, so the merge can tell that every shard was given the same files
+    import hashlib
+    return hashlib.sha256("\0".join(filelist).encode("utf8")).hexdigest()
+
+def shardFiles(filelist: list[str], index: int, count: int) -> list[tuple[int, str]]:
+    # input files are dealt out in turn, so every shard gets the same files given the same input list.
+    # each keeps its position in the whole list, so the manifests can be merged back in order.
+    return [(position, filename) for position, filename in enumerate(filelist) if position % count == index - 1]
+
+
+def encodeError(error: Exception | None) -> list[list] | None:
+    # the whole chain of causes, outermost first, as [type name, args] pairs
+    if error is None: return None
+    chain: list[list] = []
+    while error is not None:
+        args = [arg if isinstance(arg, (str, int)) else str(arg) for arg in error.args]
+        # the filename of an OSError isn't one of its args, but is taken as the third
+        if isinstance(error, OSError) and error.filename is not None and len(args) == 2: args.append(str(error.filename))
+        chain.append([type(error).__name__, args])
+        error = error.__cause__
+    return chain
+
+def decodeError(chain: list[list] | None) -> Exception | None:
+    error = None
+    for typeName, args in reversed(chain or []):
+        errorType = CCES_Exception if typeName == "CCES_Exception" else getattr(builtins, typeName, Exception)
+        if not (isinstance(errorType, type) and issubclass(errorType, Exception)): errorType = Exception
+        cause = errorType(*args)
+        cause.__cause__ = error
+        error = cause
+    return error
+
+
+def buildShard(filelist: list[str], index: int, count: int, selection: EventSelection | None = None) -> tuple[dict, dict[str, EventItem], Exception | None]:
+    # reads the files of one shard, returning its manifest, its events, and the first error found in them.
+    # an error doesn't stop the rest of the shard being read, so that the merge can report errors in
+    # the same order as a single build.
+    manifest = {
+        "parserVersion": parserVersion,
+        "cacheVersion": cacheVersion,
+        "shard": index,
+        "shards": count,
+        "inputFiles": len(filelist),
+        "inputHash": hashFilelist(filelist),
+        "files": []
+    }
+    events: dict[str, EventItem] = {}
+    firstError: Exception | None = None
+    for position, filename in shardFiles(filelist, index, count):
+        items, error = readFile(filename, None, selection)
+        manifest["files"].append({
+            "index": position,
+            "file": filename,
+            "items": [[eventTitle, item.eventType.name, item.filepath] for eventTitle, item in items],
+            "error": encodeError(error)
+        })
+        if firstError is None:
+            try:
+                mergeItems(events, filename, items, error)
+            except Exception as e:
+                firstError = e
+    return manifest, events, firstError
+
+def writeManifest(manifest: dict, filename: str) -> None:
+    directory = os.path.dirname(filename)
+    if directory: os.makedirs(directory, exist_ok = True)
+    with open(filename, "w+", encoding = "utf8") as manifestFile:
+        json.dump(manifest, manifestFile)
+
+
+class CompileResult:
+    # the output of a build that never touches the filesystem.
+    def __init__(self, events: dict[str, EventItem], indentation = None) -> None:
+        self.events: dict[str, EventItem] = events
+        self.indentation = indentation
+
+    @property
+    def commonEvents(self) -> dict[str, Events.CommonEvent]:
+        return {eventName: eventInfo.event for eventName, eventInfo in self.events.items() 
+            if eventInfo.eventType == EventItemType.STANDARD_EVENT and eventInfo.event is not None}
+
+    @property
+    def eventJson(self) -> dict[str, str]:
+        # the contents writeEventFiles would give each event's file.
+        # the JSON is kept by the events, so asking again is cheap unless they were changed.
+        return {eventName: "".join(Events.iterEncode({eventName: event}, self.indentation, cached = True)) for eventName, event in self.commonEvents.items()}
+
+    @property
+    def patch(self) -> list[dict]:
+        return generatePatchFile(self.events)
+
+    @property
+    def patchJson(self) -> str:
+        return json.dumps(self.patch, indent = self.indentation)
+
+    @property
+    def bundledPatch(self) -> list[dict]:
+        return generatePatchFile(self.events, bundle = True)
+
+
+def _sourceText(source: str | Iterable[str]) -> str:
+    if isinstance(source, str): return source
+    # lines may or may not still end in a line break, like those read from a file
+    return "\n".join(line.rstrip("\r\n") for line in source)
+
+def compileSource(source: str | Iterable[str], indentation = None, sourceName: str = "<source>") -> CompileResult:
+    return compileSources({sourceName: source}, indentation)
+
+def compileSources(sources: dict[str, str | Iterable[str]] | Iterable[str | Iterable[str]], indentation = None) -> CompileResult:
+    # compiles several sources as though they were files of one build, so duplicate titles between them are errors.
+    # unnamed sources are called "<source N>" in error messages.
+    if not isinstance(sources, dict):
+        sources = {f"<source {i}>": source for i, source in enumerate(sources)}
+    eventDict: dict[str, EventItem] = {}
+    for sourceName, source in sources.items():
+        items, error = parseSource(_sourceText(source), sourceName)
+        mergeItems(eventDict, sourceName, items, error)
+    return CompileResult(eventDict, indentation)
+
+
+def generatePatchFile(events: dict[str, EventItem], bundle: bool = False, keptDicts: bool = False) -> list[dict]:
+    # when bundled, events are set inside the patch itself instead of being imported from their own files.
+    # imports and includes are kept either way.
+    # with keptDicts, the dicts the events keep are used as they are rather than copied, so watch mode doesn't
+    # rebuild those of unchanged events, but the patch must not be modified.
     patchDict: list[dict] = []
     patchDict.append({"type": "ENTER", "index": "commonEvents"})
-    for event in events.values():
-        patchDict.append(event.genPatchStep())
+    for eventName, event in events.items():
+        if bundle and event.eventType == EventItemType.STANDARD_EVENT:
+            if event.event is not None: patchDict.append({"type": "SET_KEY", "index": eventName, "content": event.event.keptDict() if keptDicts else event.event.asDict()})
+        else:
+            patchDict.append(event.genPatchStep())
     patchDict.append({"type": "EXIT"})
     return patchDict
 
-def writeEventFiles(events: dict[str, EventItem], indentation = None) -> None:
+# how many chunks of text writeIfChanged writes and compares at a time
+writeBatchSize = 1024
+
+def writeIfChanged(filename: str, text: str | Iterable[str]) -> bool:
+    # writes the same bytes a text mode file would, but only if they differ from what's already there.
+    # the text can be given in chunks, which are written and compared with the file as they come,
+    # so it's never held whole. returns whether the file was written.
+    chunks = iter((text,) if isinstance(text, str) else text)
+    try:
+        existingFile = open(filename, "rb")
+    except OSError:
+        existingFile = None
+    # the text goes to a temporary file that replaces the file all at once, so it's never left half-written,
+    # and that's simply removed if the file was the same
+    tempFilename = f"{filename}.{os.getpid()}.tmp"
+    try:
+        tempFile = open(tempFilename, "xb")
+    except BaseException:
+        if existingFile is not None: existingFile.close()
+        raise
+    try:
+        isSame = existingFile is not None
+        with tempFile:
+            while True:
+                batch = list(itertools.islice(chunks, writeBatchSize))
+                if not batch: break
+                data = "".join(batch).replace("\n", os.linesep).encode("utf8")
+                tempFile.write(data)
+                if isSame: isSame = existingFile.read(len(data)) == data
+            # the file is only the same if it ends here too
+            if isSame: isSame = not existingFile.read(1)
+        # windows can't replace a file that's still open
+        if existingFile is not None: existingFile.close()
+        if isSame: os.remove(tempFilename)
+        else: os.replace(tempFilename, filename)
+    except BaseException:
+        if os.path.exists(tempFilename): os.remove(tempFilename)
+        raise
+    finally:
+        if existingFile is not None: existingFile.close()
+    return not isSame
+
+def writeEventFile(eventName: str, eventInfo: EventItem, indentation = None) -> tuple[bool, float, float]:
+    # returns whether the file was written, and the time spent serializing and writing it.
+    # the JSON is written as it's made, so the time spent making it is only measured when profiling.
+    directoryMatch = CCEventRegex.filepath.match(eventInfo.filepath)
+    if directoryMatch and directoryMatch.group("directory"): os.makedirs(directoryMatch.group("directory"), exist_ok= True)
+    start = time.perf_counter()
+    chunks = Events.iterEncode({eventName: eventInfo.event}, indentation, interner = interner)
+    serializeTime = [0.0]
+    if profiler is not None: chunks = _timedChunks(chunks, serializeTime)
+    wasWritten = writeIfChanged(eventInfo.filepath, chunks)
+    return wasWritten, serializeTime[0], time.perf_counter() - start - serializeTime[0]
+
+def _timedChunks(chunks: Iterator[str], total: list[float]) -> Iterator[str]:
+    # adds the time spent making each chunk to total[0]
+    while True:
+        start = time.perf_counter()
+        chunk = next(chunks, None)
+        total[0] += time.perf_counter() - start
+        if chunk is None: return
+        yield chunk
+
+def reportEventFile(eventName: str, eventInfo: EventItem, result: tuple[bool, float, float], cache: BuildCache | None = None) -> bool:
+    wasWritten, serializeTime, writeTime = result
+    if verbose:
+        if wasWritten: print(f"Writing file '{eventInfo.filepath}'.")
+        else: print(f"Skipping unchanged output file '{eventInfo.filepath}'.")
+    if profiler is not None: profiler.recordOutput(eventName, serializeTime, writeTime)
+    if cache is not None: cache.recordOutput(eventName)
+    return wasWritten
+
+def writeEventFiles(events: dict[str, EventItem], indentation = None, cache: BuildCache | None = None,
+        writer: "EventWriter | None" = None) -> tuple[int, int]:
+    # returns the number of files written and the number skipped as unchanged.
+    # events already handed to a writer are only waited for, in order, so the output is the same either way.
+    written: int = 0
+    skipped: int = 0
     os.makedirs("./patches/", exist_ok = True)
     for eventName, eventInfo in events.items():
-        filename = eventInfo.filepath
-        directoryMatch = CCEventRegex.filepath.match(filename)
-        if directoryMatch and directoryMatch.group("directory"): os.makedirs(directoryMatch.group("directory"), exist_ok= True)
         if eventInfo.eventType == EventItemType.STANDARD_EVENT:
             if eventInfo.event is None: continue
-            if verbose: print(f"Writing file '{filename}'.")
-            with open(filename, "w+") as jsonFile:
-                json.dump({eventName: eventInfo.event.asDict()}, jsonFile, indent = indentation)
+            if writer is not None and eventName in writer.pending:
+                result = writer.pending.pop(eventName).result()
+            else:
+                result = writeEventFile(eventName, eventInfo, indentation)
+            if reportEventFile(eventName, eventInfo, result, cache): written += 1
+            else: skipped += 1
+        else:
+            directoryMatch = CCEventRegex.filepath.match(eventInfo.filepath)
+            if directoryMatch and directoryMatch.group("directory"): os.makedirs(directoryMatch.group("directory"), exist_ok= True)
+    return written, skipped
+
+
+class EventWriter:
+    # writes events on a pool of threads while the build goes on, so parsing and disk access overlap.
+    # at most queueSize events wait to be written at a time; past that, handing over an event blocks until one is done.
+    # the results are collected by writeEventFiles in event order, and the first error raised by a writer is
+    # raised again by the next call to write.
+    def __init__(self, indentation = None, threads: int = 4, queueSize: int = 64) -> None:
+        import concurrent.futures, threading
+        self.indentation = indentation
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers = threads)
+        self.slots = threading.BoundedSemaphore(queueSize)
+        self.pending: dict[str, "concurrent.futures.Future"] = {}
+        self.error: BaseException | None = None
+
+    def finished(self, future: "concurrent.futures.Future") -> None:
+        self.slots.release()
+        if self.error is None and not future.cancelled() and future.exception() is not None: self.error = future.exception()
+
+    def write(self, eventName: str, eventInfo: EventItem) -> None:
+        if self.error is not None: raise self.error
+        self.slots.acquire()
+        future = self.executor.submit(writeEventFile, eventName, eventInfo, self.indentation)
+        future.add_done_callback(self.finished)
+        self.pending[eventName] = future
+
+    def close(self) -> None:
+        # waits for any write that has already started, so no temporary files are left behind
+        self.executor.shutdown(cancel_futures = True)
 
-def writeDatabasePatchfile(patchDict: dict, filename: str, indentation = None) -> None:
+class EventStreamer:
+    # writes each event as soon as it's built and then lets go of it, for --stream.
+    # only the title, path and type of every event are kept, for duplicate titles and the patch file,
+    # so memory use doesn't grow with the size of the events.
+    def __init__(self, indentation = None) -> None:
+        self.indentation = indentation
+        self.written: int = 0
+        self.skipped: int = 0
+        os.makedirs("./patches/", exist_ok = True)
+
+    def write(self, eventName: str, eventInfo: EventItem) -> None:
+        if reportEventFile(eventName, eventInfo, writeEventFile(eventName, eventInfo, self.indentation)): self.written += 1
+        else: self.skipped += 1
+        eventInfo.event = None
+
+def writeDatabasePatchfile(patchDict: dict, filename: str, indentation = None) -> bool:
     filename = filename.strip()
     fileMatch = CCEventRegex.filepath.match(filename)
-    os.makedirs(fileMatch.group("directory"), exist_ok = True)
+    if fileMatch.group("directory"): os.makedirs(fileMatch.group("directory"), exist_ok = True)
+    if not writeIfChanged(filename, json.dumps(patchDict, indent = indentation)):
+        if verbose: print(f"Skipping unchanged patch file at {filename}")
+        return False
     if verbose:
         print("Writing patch file at ./assets/data/database.json.patch")
-    with open(filename, "w+") as patchFile:
-        json.dump(patchDict, patchFile, indent = indentation)
+    return True
+
+
+def watchFiles(inputFilenames: list[str], runRecursively: bool = False, indentation = None, databaseFile: str | None = None,
+        jobs: int = 1, cacheFile: str | None = None, include: list[str] | None = None, exclude: list[str] | None = None,
+        bundle: bool = False, selection: EventSelection | None = None, indexFile: str | None = None) -> None:
+    # rebuilds whenever an input file changes, until interrupted.
+    # every build goes through the same cache, so only changed files are read and only changed events are parsed and written.
+    # a bundled patch needs every event, so those skipped as unchanged are taken from the previous build instead.
+    import traceback
+    if bundle: cacheFile = None
+    cache = BuildCache(cacheFile, indentation, optimizer is not None)
+    if indexFile is not None:
+        import CCSymbolIndex
+        index = CCSymbolIndex.SymbolIndex(indexFile)
+    previousStats: dict[str, list[int] | None] | None = None
+    previousEvents: dict[str, EventItem] = {}
+    previousPatch: list[dict] | None = None
+
+    global interner
+    while True:
+        filelist = findInputFiles(inputFilenames, runRecursively, include, exclude)
+        stats = {filename: BuildCache.fileStats(filename) for filename in filelist}
+        if stats != previousStats:
+            previousStats = stats
+            # shared steps are only kept for one build, so the interner doesn't keep growing
+            if interner is not None: interner = Events.StepInterner()
+            try:
+                allEvents = parseFiles(filelist, False, cache, jobs, selection, onTokens = None if indexFile is None else index.addTokens)
+                if bundle:
+                    for eventName, eventInfo in allEvents.items():
+                        if eventInfo.event is None and eventInfo.sourceHash is not None: eventInfo.event = previousEvents[eventName].event
+                else:
+                    writeEventFiles(allEvents, indentation, cache)
+            except Exception:
+                cache.discardBuild()
+                traceback.print_exc()
+                print("Build failed, waiting for changes...", file = sys.stderr)
+            else:
+                # remove the output of any event that no longer exists
+                for eventName, eventInfo in previousEvents.items():
+                    if bundle or eventName in allEvents or eventInfo.eventType != EventItemType.STANDARD_EVENT: continue
+                    if os.path.isfile(eventInfo.filepath):
+                        if verbose: print(f"Removing file '{eventInfo.filepath}'.")
+                        os.remove(eventInfo.filepath)
+
+                # the patch file only changes when events are added, removed or reordered
+                if databaseFile is not None:
+                    patchDict = generatePatchFile(allEvents, bundle, keptDicts = True)
+                    if patchDict != previousPatch: 
+                        writeDatabasePatchfile(patchDict, databaseFile, indentation)
+                        previousPatch = patchDict
+                cache.save()
+                if indexFile is not None: index.update(filelist)
+                previousEvents = allEvents
+                print(f"Built {len(allEvents)} events from {len(filelist)} files, watching for changes...")
+        time.sleep(watchInterval)
 
 
 if __name__ == "__main__":
+    # modules imported below that import this one under its own name, such as CCSymbolIndex,
+    # get this module rather than a second copy, so their token types are the same as its own.
+    sys.modules.setdefault("cc_eventscript_parser", sys.modules[__name__])
+    # only imported here, as nothing else needs it and it's slow to import
+    import argparse
     parser = argparse.ArgumentParser(description= "Process a cc-eventscript file and produce the relevant .json and patch files.")
     parser.add_argument("file", help="The eventscript file(s) to be processed. A file path if -r is enabled.", nargs = "+")
     parser.add_argument("-i", "--indent", type = int, default = None, dest = "indentation", metavar = "NUM", nargs = "?", const = 4, help = "the indentation outputted files should use, if any. if supplied without a number, will default to 4 spaces")
     parser.add_argument("-v", "--verbose", action="store_true", help = "increases verbosity of output")
-    parser.add_argument("-r", action = "store_true", dest = "recursive", help = "will parse all files in a single directory ending in '.cces', rather than a single file. ")
+    parser.add_argument("-r", action = "store_true", dest = "recursive", help = "will parse all files ending in '.cces' in the given directories and their subdirectories, rather than single files. ")
+    parser.add_argument("--include", action = "append", default = None, metavar = "GLOB", help = "with -r, only parse files whose path within the directory matches this pattern. may be given more than once. defaults to '*.cces'")
+    parser.add_argument("--exclude", action = "append", default = None, metavar = "GLOB", help = "with -r, skip files and directories whose path within the directory matches this pattern. may be given more than once")
+    
+    parser.add_argument("--only", action = "append", default = None, metavar = "GLOB", help = "only build events whose title matches this pattern. may be given more than once")
+    parser.add_argument("--exclude-event", action = "append", default = None, dest = "excludeEvent", metavar = "GLOB", help = "don't build events whose title matches this pattern. may be given more than once")
+    parser.add_argument("--index", default = None, dest = "indexFile", metavar = "INDEX", nargs = "?", const = "./.cces-index.sqlite", help = "update a SQLite index of the variables, labels and characters used in the input files, to be searched with CCSymbolIndex.py. if supplied without a path, will default to './.cces-index.sqlite'")
+    parser.add_argument("-w", "--watch", action = "store_true", help = "keep running and rebuild whenever an input file changes")
+    parser.add_argument("-j", "--jobs", type = int, default = 1, metavar = "NUM", help = "the number of processes to parse input files with. defaults to 1")
+    parser.add_argument("--pipeline", type = int, default = None, dest = "writerThreads", metavar = "THREADS", nargs = "?", const = 4, help = "write each event on a pool of threads as soon as it's built, rather than after every file has been parsed. if supplied without a number, will default to 4 threads")
+    parser.add_argument("--stream", action = "store_true", help = "write each event as soon as it's built and free it straight away, so memory use stays flat however many events there are")
+    parser.add_argument("--shard", type = parseShard, default = None, metavar = "i/N", help = "only build every Nth input file, starting from the ith, and write a manifest of their events to be merged into the patch file by 'CCShards.py merge'")
+    parser.add_argument("--manifest", default = None, dest = "manifestFile", metavar = "MANIFEST", help = "with --shard, the location of the manifest. defaults to './cces-shard-i-of-N.json'")
+    parser.add_argument("-O", "--optimize", action = "store_true", help = "fold constant conditions, remove steps that can never run and merge consecutive changes to the same variable, then report what was removed and the size of the output before and after")
+    parser.add_argument("--share-steps", action = "store_true", dest = "shareSteps", help = "share identical steps between messages and events, and encode each of them only once")
+    parser.add_argument("--profile", default = None, dest = "profileFile", metavar = "REPORT", nargs = "?", const = "./cces-profile.json", help = "print how long each phase of the build took and save a JSON report. if supplied without a path, will default to './cces-profile.json'")
+    parser.add_argument("--profile-memory", action = "store_true", dest = "profileMemory", help = "also record peak memory use with tracemalloc when profiling (slow)")
+    parser.add_argument("--diagnostics", default = None, dest = "diagnosticsFile", metavar = "REPORT", nargs = "?", const = "", help = "report every error and warning in the input files with its location, rather than stopping at the first error. nothing is written if there are any errors. if a path is supplied, also saves them there as JSON")
+    parser.add_argument("-c", "--cache", default = None, dest = "cacheFile", metavar = "CACHE", nargs = "?", const = "./.cces-cache.json", help = "keep a build cache so unchanged files and events are skipped on the next run. if supplied without a path, will default to './.cces-cache.json'")
     
     databaseGroup = parser.add_mutually_exclusive_group()
     databaseGroup.add_argument("--no-patch-file", action = "store_false", dest = "genPatch", help = "do not generate a 'database.json.patch' file")
     databaseGroup.add_argument("-p", "--patch-file", default = "./assets/data/database.json.patch", dest = "databaseFile", metavar = "DATABASE", help = "the location of the database patch file")
+    parser.add_argument("-b", "--bundle", action = "store_true", help = "write every event into the patch file itself rather than into separate files in './patches'")
 
 
 
     args = parser.parse_args()
+    # files given by name are always parsed, so patterns can only pick among those found in directories
+    if not args.recursive and args.include: parser.error("argument --include: only allowed with argument -r")
+    if not args.recursive and args.exclude: parser.error("argument --exclude: only allowed with argument -r")
+    if args.bundle and not args.genPatch: parser.error("argument -b/--bundle: not allowed with argument --no-patch-file")
+    if args.bundle and args.cacheFile: parser.error("argument -b/--bundle: not allowed with argument -c/--cache")
+    if args.bundle and args.writerThreads: parser.error("argument -b/--bundle: not allowed with argument --pipeline")
+    # a bundled patch replaces every event, so it can't leave any of them out
+    if args.bundle and args.only: parser.error("argument -b/--bundle: not allowed with argument --only")
+    if args.bundle and args.excludeEvent: parser.error("argument -b/--bundle: not allowed with argument --exclude-event")
+    if args.watch and args.writerThreads: parser.error("argument -w/--watch: not allowed with argument --pipeline")
+    if args.shard:
+        if args.bundle: parser.error("argument --shard: not allowed with argument -b/--bundle")
+        if args.cacheFile: parser.error("argument --shard: not allowed with argument -c/--cache")
+        if args.writerThreads: parser.error("argument --shard: not allowed with argument --pipeline")
+        if args.stream: parser.error("argument --shard: not allowed with argument --stream")
+        if args.diagnosticsFile is not None: parser.error("argument --shard: not allowed with argument --diagnostics")
+        if args.watch: parser.error("argument --shard: not allowed with argument -w/--watch")
+        if args.jobs > 1: parser.error("argument --shard: not allowed with argument -j/--jobs")
+    elif args.manifestFile: parser.error("argument --manifest: only allowed with argument --shard")
+    if args.stream and args.bundle: parser.error("argument --stream: not allowed with argument -b/--bundle")
+    if args.stream and args.cacheFile: parser.error("argument --stream: not allowed with argument -c/--cache")
+    if args.stream and args.writerThreads: parser.error("argument --stream: not allowed with argument --pipeline")
+    if args.stream and args.shareSteps: parser.error("argument --stream: not allowed with argument --share-steps")
+    if args.stream and args.watch: parser.error("argument --stream: not allowed with argument -w/--watch")
+    if args.stream and args.diagnosticsFile is not None: parser.error("argument --stream: not allowed with argument --diagnostics")
+    if args.diagnosticsFile is not None and args.watch: parser.error("argument --diagnostics: not allowed with argument -w/--watch")
+    if args.diagnosticsFile is not None and args.writerThreads: parser.error("argument --diagnostics: not allowed with argument --pipeline")
     inputFiles = args.file
     verbose = args.verbose
+    selection = EventSelection(args.only, args.excludeEvent) if args.only or args.excludeEvent else None
+    if args.shareSteps: interner = Events.StepInterner()
+    if args.optimize:
+        import CCOptimizer
+        # watch mode never prints the report, so it doesn't measure the size of the output for it
+        optimizer = CCOptimizer.StepOptimizer(measureSize = not args.watch)
+
+    if args.watch:
+        try:
+            watchFiles(inputFiles, args.recursive, args.indentation, args.databaseFile if args.genPatch else None, args.jobs, args.cacheFile,
+                args.include, args.exclude, args.bundle, selection, args.indexFile)
+        except KeyboardInterrupt:
+            pass
+        sys.exit()
+
+    cache = BuildCache(args.cacheFile, args.indentation, args.optimize) if args.cacheFile else None
+    jobs = args.jobs
+    if args.profileFile:
+        profiler = BuildProfiler(args.profileMemory)
+        # timings can only be collected in this process
+        jobs = 1
+    if args.diagnosticsFile is not None:
+        diagnostics = Diagnostics()
+        # every file is checked in this process, whether or not it changed since the last build
+        cache = None
+        jobs = 1
+
+    inputFiles = findInputFiles(inputFiles, args.recursive, args.include, args.exclude)
+    onTokens = None
+    if args.indexFile:
+        # only imported when needed, as it imports this module in turn
+        import CCSymbolIndex
+        index = CCSymbolIndex.SymbolIndex(args.indexFile)
+        onTokens = index.addTokens
+    if args.shard:
+        # the manifest is written even if the shard has errors, so the merge can report them in order
+        manifest, allEvents, shardError = buildShard(inputFiles, *args.shard, selection)
+        manifestFile = args.manifestFile or defaultManifest(*args.shard)
+        writeManifest(manifest, manifestFile)
+        if verbose: print(f"Wrote manifest '{manifestFile}'.")
+        if shardError is not None: raise shardError
+        written, skipped = writeEventFiles(allEvents, args.indentation)
+    elif args.stream:
+        streamer = EventStreamer(args.indentation)
+        allEvents = parseFiles(inputFiles, False, None, jobs, selection, streamer.write, streaming = True, onTokens = onTokens)
+        written, skipped = writeEventFiles(allEvents, args.indentation)
+        written += streamer.written
+        skipped += streamer.skipped
+    elif args.writerThreads:
+        writer = EventWriter(args.indentation, args.writerThreads)
+        try:
+            allEvents = parseFiles(inputFiles, False, cache, jobs, selection, writer.write, onTokens = onTokens)
+            written, skipped = writeEventFiles(allEvents, args.indentation, cache, writer)
+        finally:
+            writer.close()
+    else:
+        allEvents = parseFiles(inputFiles, False, cache, jobs, selection, onTokens = onTokens)
+        if diagnostics is not None:
+            diagnostics.printSummary()
+            if args.diagnosticsFile:
+                with open(args.diagnosticsFile, "w+", encoding = "utf8") as reportFile:
+                    json.dump(diagnostics.asDict(), reportFile, indent = 4)
+            if diagnostics.errorCount:
+                print("No files were written, as there were errors.", file = sys.stderr)
+                sys.exit(1)
+        written, skipped = writeEventFiles(allEvents, args.indentation, cache) if not args.bundle else (0, 0)
+    if args.genPatch and not args.shard:
+        patchStart = time.perf_counter()
+        if writeDatabasePatchfile(generatePatchFile(allEvents, args.bundle, keptDicts = True), args.databaseFile, args.indentation): written += 1
+        else: skipped += 1
+        if profiler is not None: profiler.phases["patchFile"] += time.perf_counter() - patchStart
+    print(f"Wrote {written} files, skipped {skipped} unchanged files.")
+    if optimizer is not None: optimizer.printSummary()
 
-    allEvents = parseFiles(inputFiles, args.recursive)
-    writeEventFiles(allEvents, args.indentation)
-    if args.genPatch: writeDatabasePatchfile(generatePatchFile(allEvents), args.databaseFile, args.indentation)
+    if profiler is not None:
+        profiler.finish()
+        profiler.printSummary()
+        with open(args.profileFile, "w+", encoding = "utf8") as reportFile:
+            json.dump(profiler.asDict(), reportFile, indent = 4)
+    if cache is not None: cache.save()
+    if args.indexFile:
+        # files the build skipped as unchanged are read by the index itself, if it doesn't have them yet
+        indexed, _ = index.update(inputFiles)
+        index.close()
+        if verbose: print(f"Indexed {indexed} changed files.")